@@ -0,0 +1,764 @@
+
+#
+# acepool : pools of long-lived ACE processes for Demophin
+#
+# Loading a grammar image usually takes much longer than parsing or
+# generating a single item, so rather than starting ACE for every
+# request the processes are kept open and checked out as needed.
+# Processes are only interchangeable if they were started with the
+# same grammar and options, so an AceRegistry keeps one pool for each
+# such combination and bounds the total number of open processes.
+
+import time
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+
+class AcePoolError(Exception):
+    pass
+
+
+class AcePoolBusy(AcePoolError):
+    # too many requests are waiting for a process, or one waited too long
+    pass
+
+
+# the response given by AcePool.interact_many() for an item that took
+# longer than its time budget
+TIMED_OUT = object()
+
+
+class BasePool(object):
+    """
+    The state of a pool of interchangeable ACE processes.
+
+    This is shared by AcePool and aioace.AsyncAcePool, which add the
+    locking, waiting, and process I/O; arguments are as for AcePool.
+    The methods here only change the state, so they must be called
+    with the pool's lock held.
+    """
+
+    # what _claim() returns when there is no idle process
+    NEW = object()  # room was counted for a new process
+    WAIT = object()  # the caller must wait for a process to be returned
+
+    def __init__(self, cls, grm, minsize=1, maxsize=4, registry=None,
+                 maxqueue=None, **kwargs):
+        if maxsize < 1 or minsize > maxsize:
+            raise ValueError(
+                'Invalid pool size (min: {}, max: {})'
+                .format(minsize, maxsize)
+            )
+        self.cls = cls
+        self.grm = grm
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.registry = registry
+        self.maxqueue = maxqueue
+        self.kwargs = kwargs
+        self.cmdargs = kwargs.get('cmdargs') or []
+        self._idle = []  # (time of last use, process); oldest first
+        self._size = 0  # open processes, both idle and checked out
+        self._waiting = 0  # checkouts waiting for a process
+        self._closed = False
+
+    def __repr__(self):
+        return '<{} of {} for {} {} ({}/{}) at {}>'.format(
+            self.__class__.__name__, self.cls.__name__, self.grm,
+            ' '.join(self.cmdargs), self._size, self.maxsize, id(self)
+        )
+
+    def _claim(self, dead, queued):
+        # an idle process, or NEW after counting a new one, or WAIT
+        # after counting the caller as waiting (unless it is *queued*
+        # already); dead idle processes are uncounted and added to
+        # *dead*, to be killed once the lock is released
+        if self._closed:
+            raise AcePoolError('The pool has been closed.')
+        proc = self._pop_idle(dead)
+        if proc is not None:
+            return proc
+        if self._size < self.maxsize:
+            self._size += 1
+            return self.NEW
+        if not queued:
+            if self.maxqueue is not None and self._waiting >= self.maxqueue:
+                raise AcePoolBusy(
+                    'Too many requests are waiting for an ACE process.'
+                )
+            self._waiting += 1
+        return self.WAIT
+
+    def _pop_idle(self, dead):
+        # most recently used first, so surplus processes stay idle
+        # long enough to be evicted
+        while self._idle:
+            _, proc = self._idle.pop()
+            if proc.is_alive():
+                return proc
+            self._size -= 1
+            dead.append(proc)
+        return None
+
+    def _put_back(self, proc, discard):
+        # keep the checked-in *proc* as idle and return True, or
+        # uncount it and return False if it is to be killed
+        if discard or self._closed or not proc.is_alive():
+            self._size -= 1
+            return False
+        self._idle.append((time.time(), proc))
+        return True
+
+    def _below_minimum(self):
+        return not self._closed and self._size < self.minsize
+
+    def _close_idle(self):
+        # refuse further checkouts and return the idle processes,
+        # uncounted, to be closed once the lock is released
+        self._closed = True
+        idle, self._idle = self._idle, []
+        self._size -= len(idle)
+        return [proc for _, proc in idle]
+
+    def _idle_rank(self):
+        # how soon the registry should evict an idle process of this
+        # pool (lowest first: pools above their minimum size, then the
+        # longest idle), or None if no process is idle
+        if not self._idle:
+            return None
+        return (self._size <= self.minsize, self._idle[0][0])
+
+    def _pop_oldest(self):
+        # the longest-idle process, uncounted, for the registry to kill
+        if not self._idle:
+            return None
+        _, proc = self._idle.pop(0)
+        self._size -= 1
+        return proc
+
+
+class AcePool(BasePool):
+    """
+    A pool of interchangeable ACE processes.
+
+    Args:
+        cls: the process class to instantiate (e.g., AceParser)
+        grm: path to the compiled grammar image
+        minsize: number of processes to keep open even when idle
+        maxsize: maximum number of processes open at once
+        registry: the AceRegistry that limits the total number of
+            processes across pools, if any
+        maxqueue: maximum number of checkouts waiting for a process
+            at once (`None` for no limit); others are refused
+        kwargs: additional arguments for *cls* (cmdargs, executable,
+            env, ...)
+    """
+
+    def __init__(self, cls, grm, minsize=1, maxsize=4, registry=None,
+                 maxqueue=None, **kwargs):
+        BasePool.__init__(self, cls, grm, minsize=minsize, maxsize=maxsize,
+                          registry=registry, maxqueue=maxqueue, **kwargs)
+        self._cond = threading.Condition()
+
+    def start(self):
+        """Open processes until the pool has at least *minsize*."""
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.minsize:
+                    return
+                self._size += 1
+            if not self._reserve(time.time()):
+                continue
+            proc = self._spawn()
+            with self._cond:
+                self._idle.append((time.time(), proc))
+                self._cond.notify()
+
+    def checkout(self, timeout=None):
+        """
+        Return an idle process, opening a new one if necessary.
+
+        If *maxsize* processes are already checked out, or the registry
+        has no room for another, wait up to *timeout* seconds (or
+        indefinitely if *timeout* is `None`) for one to be returned.
+        AcePoolBusy is raised if the time runs out, or if *maxqueue*
+        checkouts are already waiting.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            dead = []
+            queued = False
+            try:
+                with self._cond:
+                    proc = self._claim(dead, queued)
+                    while proc is self.WAIT:
+                        queued = True
+                        self._cond.wait(_remaining(deadline))
+                        proc = self._claim(dead, queued)
+            finally:
+                if queued:
+                    with self._cond:
+                        self._waiting -= 1
+                for dead_proc in dead:
+                    logging.warning('Discarding dead ACE process: %r', self)
+                    self._kill(dead_proc)
+            if proc is not self.NEW:
+                return proc
+            if self._reserve(deadline):
+                return self._spawn()
+
+    def checkin(self, proc, discard=False):
+        """
+        Return *proc* to the pool.
+
+        If *discard* is `True` or *proc* has died, it is killed instead
+        and a replacement is opened in the background if the pool has
+        fallen below *minsize*.
+        """
+        with self._cond:
+            keep = self._put_back(proc, discard)
+            replenish = not keep and self._below_minimum()
+            self._cond.notify()
+        if keep:
+            if self.registry is not None:
+                self.registry._notify()
+            return
+        self._kill(proc)
+        if replenish:
+            _background(self.health_check)
+
+    @contextmanager
+    def process(self, timeout=None):
+        """
+        Check out a process for the duration of a `with` block.
+
+        *timeout* is as for checkout().
+
+        If the block raises an exception, the process is in an unknown
+        state so it is discarded rather than returned to the pool.
+        """
+        proc = self.checkout(timeout=timeout)
+        try:
+            yield proc
+        except BaseException:
+            self.checkin(proc, discard=True)
+            raise
+        else:
+            self.checkin(proc)
+
+    def interact_many(self, data, from_iterable, timeout=None, budget=None):
+        """
+        Yield `(datum, response, seconds)` for each item in *data*.
+
+        The items are streamed through a single checked-out process by
+        *from_iterable* (e.g., minidelphin.parse_from_iterable, called
+        with the open process and an iterable). No process is checked
+        out until the first item is available, so an empty *data* needs
+        none. If ACE dies while answering an item, that item gets a
+        response of `None` and the rest continue on a new process. If
+        ACE spends more than *budget* seconds (if not `None`) on one
+        item, it is killed the same way and the item gets a response of
+        TIMED_OUT. Errors raised by *data* itself are re-raised once the
+        items sent before them have been answered.
+        """
+        data = iter(data)
+        pending = deque()  # sent but not yet answered
+        failed = []  # the error raised by *data*, if any
+
+        def feed(retry):
+            for datum in retry:
+                pending.append(datum)
+                yield datum
+            while not failed:
+                try:
+                    datum = next(data)
+                except StopIteration:
+                    return
+                except Exception as e:
+                    # not ACE's fault; stop sending so it is not
+                    # mistaken for an I/O error below
+                    failed.append(e)
+                    return
+                pending.append(datum)
+                yield datum
+
+        try:
+            retry = [next(data)]
+        except StopIteration:
+            return
+        while True:
+            proc = self.checkout(timeout=timeout)
+            # unless the batch completes, the process may still be working
+            # on input that was sent ahead, so it cannot be reused
+            discard = True
+            start = time.time()
+            # only ACE's time counts, not the consumer's
+            watchdog = Watchdog(proc, budget)
+            watchdog.start()
+            try:
+                for response in from_iterable(proc, feed(retry)):
+                    watchdog.cancel()
+                    datum = pending.popleft()
+                    now = time.time()
+                    if proc.at_eof():
+                        # ACE died before finishing this response
+                        if watchdog.expired:
+                            response = TIMED_OUT
+                        else:
+                            response = None
+                        yield datum, response, now - start
+                        break
+                    yield datum, response, now - start
+                    if watchdog.expired or not proc.is_alive():
+                        # ACE died after answering (e.g., on input sent
+                        # ahead); the unanswered items are tried again
+                        break
+                    start = now
+                    watchdog.start()
+                else:
+                    discard = False
+            except (IOError, OSError, ValueError):
+                # the process died while input was being sent, or gave
+                # output that could not be read
+                if not pending:
+                    raise
+                yield (pending.popleft(),
+                       TIMED_OUT if watchdog.expired else None,
+                       time.time() - start)
+            finally:
+                watchdog.cancel()
+                self.checkin(proc, discard=discard)
+            if not discard:  # every item sent was answered
+                if failed:
+                    raise failed[0]
+                return
+            logging.warning('ACE failed during a batch; restarting: %r', self)
+            retry = list(pending)
+            pending.clear()
+
+    def interact_parallel(self, data, from_iterable, workers=None,
+                          ordered=True, window=None, timeout=None,
+                          budget=None):
+        """
+        Like interact_many(), but spread over several processes.
+
+        Each of *workers* threads (by default, one per CPU) checks out
+        a process and takes the next item from *data* whenever it is
+        ready for one, so a slow item only holds up its own process.
+        No more workers are used than the pool (or the registry) may
+        open processes; a smaller number is logged. If *ordered* is
+        `True`, results are yielded in the order of *data*, otherwise
+        as they complete. At most *window* items (by default, 16 per
+        worker) are taken from *data* before their results are
+        yielded, which bounds memory when the consumer or a slow item
+        falls behind. *budget* is as for interact_many().
+        """
+        requested = workers or multiprocessing.cpu_count()
+        workers = min(requested, self.maxsize)
+        if self.registry is not None:
+            workers = min(workers, self.registry.maxprocs)
+        workers = max(1, workers)
+        if workers < requested:
+            logging.info('Using %d ACE processes of %d requested: %r',
+                         workers, requested, self)
+        if window is None:
+            window = 16 * workers
+        free = [window]  # slots for items taken but not yet yielded
+        done = [False]  # True once *data* is exhausted
+        cond = threading.Condition()
+        stop = threading.Event()
+        lock = threading.Lock()
+        results = queue.Queue()
+        data = enumerate(data)
+
+        def release():
+            with cond:
+                free[0] += 1
+                cond.notify()
+
+        def feed(mine):
+            # Items for one run of interact_many(). ACE is sent each
+            # item before it answers the last, so a worker must not
+            # wait for a slot while its process has an item to answer
+            # (e.g., the one that, in order, every slot waits on); the
+            # run ends instead, and the next one waits for the slot.
+            while True:
+                with cond:
+                    while not (free[0] > 0 or stop.is_set() or done[0]):
+                        if mine:
+                            return
+                        cond.wait()
+                    if stop.is_set() or done[0]:
+                        return
+                    free[0] -= 1
+                with lock:
+                    try:
+                        item = next(data)
+                    except StopIteration:
+                        with cond:
+                            done[0] = True
+                            free[0] += 1
+                            cond.notify_all()
+                        return
+                    except BaseException:
+                        release()
+                        raise
+                mine.append(item[0])
+                yield item
+
+        def work():
+            mine = deque()  # indices of this worker's unanswered items
+            try:
+                while not (stop.is_set() or done[0]):
+                    for item, response, seconds in self.interact_many(
+                            feed(mine),
+                            lambda proc, items: from_iterable(
+                                proc, (datum for _, datum in items)
+                            ),
+                            timeout=timeout, budget=budget):
+                        mine.popleft()
+                        results.put((item[0], item[1], response, seconds))
+                        if stop.is_set():
+                            break
+            except BaseException as e:
+                results.put(e)
+            results.put(None)
+
+        threads = [threading.Thread(target=work) for _ in range(workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        try:
+            running = workers
+            waiting = {}  # results that completed ahead of their turn
+            nextidx = 0
+            while running:
+                result = results.get()
+                if result is None:
+                    running -= 1
+                    continue
+                if isinstance(result, BaseException):
+                    raise result
+                i, datum, response, seconds = result
+                if not ordered:
+                    release()
+                    yield datum, response, seconds
+                    continue
+                waiting[i] = (datum, response, seconds)
+                while nextidx in waiting:
+                    release()
+                    yield waiting.pop(nextidx)
+                    nextidx += 1
+        finally:
+            with cond:
+                stop.set()
+                cond.notify_all()
+
+    def health_check(self):
+        """Discard idle processes that have died and refill the pool."""
+        with self._cond:
+            dead = [p for _, p in self._idle if not p.is_alive()]
+            if dead:
+                self._idle = [(t, p) for t, p in self._idle
+                              if p not in dead]
+                self._size -= len(dead)
+        for proc in dead:
+            logging.warning('Discarding dead ACE process: %r', self)
+            self._kill(proc)
+        try:
+            self.start()
+        except Exception:
+            logging.exception('Could not restart ACE process: %r', self)
+
+    def close(self):
+        """Close all idle processes and refuse further checkouts."""
+        with self._cond:
+            idle = self._close_idle()
+            self._cond.notify_all()
+        for proc in idle:
+            try:
+                proc.close()
+            except Exception:
+                _kill(proc)
+            if self.registry is not None:
+                self.registry._release()
+
+    def _reserve(self, deadline):
+        # get room for a new process from the registry; if instead an
+        # idle process appears in this pool, give up the pool slot
+        try:
+            if self.registry is None or self.registry._reserve(self,
+                                                               deadline):
+                return True
+        except BaseException:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._size -= 1
+        return False
+
+    def _spawn(self):
+        try:
+            proc = self.cls(self.grm, **self.kwargs)
+        except BaseException:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            if self.registry is not None:
+                self.registry._release()
+            raise
+        logging.debug('Started ACE process: %r', self)
+        return proc
+
+    def _kill(self, proc):
+        _kill(proc)
+        if self.registry is not None:
+            self.registry._release()
+
+
+class Watchdog(object):
+    """
+    Abort an ACE process that spends more than *seconds* on a request.
+
+    A timer runs between start() and cancel() (or for the duration of
+    a `with` block). If it runs out, *expired* is set to `True` and the
+    process is aborted, so whatever is waiting on its output gets EOF;
+    the process should then be discarded, as AcePool.checkin() does
+    for processes that have died. If *seconds* is `None`, there is no
+    limit.
+    """
+
+    def __init__(self, proc, seconds):
+        self.proc = proc
+        self.seconds = seconds
+        self.expired = False
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cancel()
+        return False
+
+    def start(self):
+        if self.seconds is None or self.expired:
+            return
+        timer = threading.Timer(self.seconds, self._expire)
+        timer.daemon = True
+        with self._lock:
+            self._timer = timer
+        timer.start()
+
+    def cancel(self):
+        with self._lock:
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+
+    def _expire(self):
+        with self._lock:
+            if self._timer is not threading.current_thread():
+                return  # cancelled just as the time ran out
+            self._timer = None
+            self.expired = True
+        logging.warning('ACE took longer than %g seconds; stopping it: %r',
+                        self.seconds, self.proc)
+        self.proc.abort()
+
+
+class BaseRegistry(object):
+    """
+    The state of a set of pools keyed by grammar and options.
+
+    This is shared by AceRegistry and aioace.AsyncAceRegistry, which
+    add the locking, waiting, and process I/O. The methods here must
+    be called with the registry's lock held.
+    """
+
+    _pool_class = None  # the class of the pools in the registry
+
+    def __init__(self, maxprocs=8):
+        if maxprocs < 1:
+            raise ValueError('Invalid process limit: {}'.format(maxprocs))
+        self.maxprocs = maxprocs
+        self._pools = {}
+        self._total = 0
+
+    def __repr__(self):
+        return '<{} of {} pools ({}/{}) at {}>'.format(
+            self.__class__.__name__, len(self._pools), self._total,
+            self.maxprocs, id(self)
+        )
+
+    def _find_pool(self, cls, grm, cmdargs, version, **kwargs):
+        # the pool for *cls* on *grm* with *cmdargs*, created if it does
+        # not exist yet, and the pools forgotten for other versions of
+        # *grm*, to be closed once the lock is released
+        cmdargs = normalize_cmdargs(cmdargs)
+        key = (cls, grm, tuple(cmdargs), version)
+        pool = self._pools.get(key)
+        stale = []
+        if pool is None:
+            for k in list(self._pools):
+                if k[1] == grm and k[3] != version:
+                    stale.append(self._pools.pop(k))
+            pool = self._pool_class(cls, grm, registry=self,
+                                    cmdargs=cmdargs, **kwargs)
+            self._pools[key] = pool
+        return pool, stale
+
+    def _make_room(self, pool):
+        # count a new process for *pool* and return None; or return an
+        # idle process to kill, whose place passes to *pool*; or False
+        # if *pool* itself has an idle process to use instead; or
+        # BasePool.WAIT if none of these is possible yet
+        if self._total < self.maxprocs:
+            self._total += 1
+            return None
+        with self._locked(pool):
+            if pool._idle:
+                return False
+        victim = self._evict()
+        return BasePool.WAIT if victim is None else victim
+
+    def _evict(self):
+        # take the least-recently-used idle process, preferring pools
+        # above their minimum size. No checkout of the victim's pool
+        # can be waiting, as it has an idle process, so the pool need
+        # not be notified.
+        best = None
+        for pool in self._pools.values():
+            with self._locked(pool):
+                rank = pool._idle_rank()
+            if rank is not None and (best is None or rank < best[0]):
+                best = (rank, pool)
+        if best is None:
+            return None
+        with self._locked(best[1]):
+            return best[1]._pop_oldest()
+
+    def _locked(self, pool):
+        # a context manager holding *pool*'s lock
+        raise NotImplementedError
+
+
+class AceRegistry(BaseRegistry):
+    """
+    Pools of ACE processes keyed by grammar and command-line options.
+
+    Requests that need the same grammar and options share warm
+    processes, while the total number of processes open across all
+    pools is kept at or below *maxprocs*. When a new process is needed
+    and the limit has been reached, the least-recently-used idle
+    process is closed to make room.
+    """
+
+    _pool_class = AcePool
+
+    def __init__(self, maxprocs=8):
+        BaseRegistry.__init__(self, maxprocs)
+        self._cond = threading.Condition()
+
+    def pool(self, cls, grm, cmdargs=None, minsize=0, maxsize=4,
+             maxqueue=None, version=None, **kwargs):
+        """
+        Return the pool for *cls* on *grm* with *cmdargs*.
+
+        The pool is created if it does not exist yet; otherwise the
+        size, queue, and process arguments are those of the existing
+        pool. *version* identifies the contents of *grm* (e.g., its
+        modification time); when a pool is created for a new version,
+        the pools for other versions of *grm* are closed, as their
+        processes still have the old grammar loaded.
+        """
+        with self._cond:
+            pool, stale = self._find_pool(
+                cls, grm, cmdargs, version, minsize=minsize,
+                maxsize=maxsize, maxqueue=maxqueue, **kwargs
+            )
+        for old in stale:
+            logging.info('Closing ACE processes for a replaced grammar: %r',
+                         old)
+            old.close()
+        return pool
+
+    def pools(self):
+        with self._cond:
+            return list(self._pools.values())
+
+    def close(self):
+        """Close and forget all pools."""
+        with self._cond:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        for pool in pools:
+            pool.close()
+
+    def _reserve(self, pool, deadline):
+        # Reserve room for one more process for *pool*, evicting an
+        # idle process if necessary. Returns False if *pool* itself
+        # has an idle process that can be used instead.
+        with self._cond:
+            room = self._make_room(pool)
+            while room is BasePool.WAIT:
+                self._cond.wait(_remaining(deadline))
+                room = self._make_room(pool)
+        if room is False:
+            return False
+        if room is not None:
+            logging.debug('Evicting idle ACE process for: %r', pool)
+            _kill(room)
+        return True
+
+    def _locked(self, pool):
+        return pool._cond
+
+    def _release(self):
+        with self._cond:
+            self._total -= 1
+            self._cond.notify()
+
+    def _notify(self):
+        with self._cond:
+            self._cond.notify()
+
+
+def normalize_cmdargs(cmdargs):
+    """Return *cmdargs* without duplicates and in a canonical order."""
+    return sorted(set(cmdargs or []))
+
+
+def _remaining(deadline):
+    if deadline is None:
+        return None
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise AcePoolBusy('Timed out waiting for an ACE process.')
+    return remaining
+
+
+def _kill(proc):
+    try:
+        proc.kill()
+    except Exception:
+        logging.exception('Could not kill ACE process.')
+
+
+def _background(func, *args):
+    t = threading.Thread(target=func, args=args)
+    t.daemon = True
+    t.start()
+    return t
@@ -0,0 +1,525 @@
+
+#
+# aioace : asyncio interface to ACE for Demophin
+#
+# The processes in minidelphin and acepool block the calling thread
+# while ACE works, so serving many requests at once needs as many
+# threads. These classes talk to ACE through asyncio instead, so a
+# single thread can have requests in flight on every process of a pool
+# while others wait their turn. Responses are read with the same
+# readers as minidelphin's AceParser and AceGenerator.
+#
+# ThreadedAceRegistry lets threads (e.g., the Bottle application's,
+# serving batches) use the same pools, so one limit on the number of
+# processes covers both.
+#
+# This module requires Python 3.7 or later.
+
+import os
+import time
+import asyncio
+import logging
+import contextlib
+
+from minidelphin import (
+    AceParser, AceGenerator, AceParserReader, AceGeneratorReader
+)
+from acepool import AcePool, AcePoolBusy, BasePool, BaseRegistry
+
+# ACE output lines (e.g., a large MRS) can exceed asyncio's default
+# 64 KiB line limit
+_LINE_LIMIT = 2 ** 24
+
+
+class AsyncAceProcess(object):
+    """
+    An ACE process used through asyncio.
+
+    Args are as for minidelphin.AceProcess. The process is not started
+    until open() is awaited, or the object is used with `async with`.
+    """
+
+    _cmdargs = []
+    _reader = None  # the response reader class
+
+    def __init__(self, grm, cmdargs=None, executable=None, env=None, **kwargs):
+        if not os.path.isfile(grm):
+            raise ValueError("Grammar file %s does not exist." % grm)
+        self.grm = grm
+        self.cmdargs = cmdargs or []
+        self.executable = executable or 'ace'
+        self.env = env or os.environ
+        self._p = None
+        self._eof = False
+
+    async def open(self):
+        self._eof = False
+        self._p = await asyncio.create_subprocess_exec(
+            self.executable, '-g', self.grm, *(self._cmdargs + self.cmdargs),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            env=self.env,
+            limit=_LINE_LIMIT
+        )
+        return self
+
+    async def __aenter__(self):
+        if self._p is None:
+            await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+        return False  # don't try to handle any exceptions
+
+    async def send(self, datum):
+        self._p.stdin.write((datum.rstrip() + '\n').encode('utf-8'))
+        await self._p.stdin.drain()
+
+    async def receive(self):
+        reader = self._reader()
+        line = await self._readline()
+        while not (self._eof or reader.feed(line)):
+            line = await self._readline()
+        return reader.finish()
+
+    async def _readline(self):
+        line = await self._p.stdout.readline()
+        if not line:
+            self._eof = True  # ACE closed its output; it is exiting
+        return line.decode('utf-8', 'replace').rstrip()
+
+    async def interact(self, datum):
+        await self.send(datum)
+        return await self.receive()
+
+    def is_alive(self):
+        return not self._eof and self._p.returncode is None
+
+    def at_eof(self):
+        # as minidelphin.AceProcess.at_eof()
+        return self._eof
+
+    def abort(self):
+        # stop ACE without waiting for it, as AceProcess.abort(); what
+        # is reading its output gets EOF
+        if self._p.returncode is None:
+            try:
+                self._p.kill()
+            except ProcessLookupError:
+                pass
+
+    async def close(self):
+        self._p.stdin.close()
+        while True:
+            line = await self._p.stdout.readline()
+            if not line:
+                break
+            logging.debug('ACE cleanup: {}'.format(line.decode('utf-8').rstrip()))
+        return await self._p.wait()
+
+    async def kill(self):
+        # for processes that may be hung or in an unknown state
+        if self._p.returncode is None:
+            try:
+                self._p.kill()
+            except ProcessLookupError:
+                pass
+        self._p.stdin.close()
+        return await self._p.wait()
+
+
+class AsyncAceParser(AsyncAceProcess):
+
+    _reader = AceParserReader
+
+
+class AsyncAceGenerator(AsyncAceProcess):
+
+    _cmdargs = ['-e']
+    _reader = AceGeneratorReader
+
+
+class AsyncAcePool(BasePool):
+    """
+    A pool of interchangeable ACE processes used through asyncio.
+
+    Like acepool.AcePool, but requests waiting for a process suspend
+    rather than block, so any number of them may wait at once. The pool
+    must be used from a single event loop.
+
+    Args:
+        cls: the process class to instantiate (e.g., AsyncAceParser)
+        grm: path to the compiled grammar image
+        minsize: number of processes to keep open even when idle
+        maxsize: maximum number of processes open at once
+        registry: the AsyncAceRegistry that limits the total number of
+            processes across pools, if any
+        maxqueue: maximum number of checkouts waiting for a process
+            at once (`None` for no limit); others are refused
+        kwargs: additional arguments for *cls* (cmdargs, executable,
+            env, ...)
+    """
+
+    def __init__(self, cls, grm, minsize=1, maxsize=4, registry=None,
+                 maxqueue=None, **kwargs):
+        BasePool.__init__(self, cls, grm, minsize=minsize, maxsize=maxsize,
+                          registry=registry, maxqueue=maxqueue, **kwargs)
+        self._cond = None  # created in the event loop on first use
+
+    @property
+    def cond(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def start(self):
+        """Open processes until there are at least *minsize*."""
+        while True:
+            if self._closed or self._size >= self.minsize:
+                return
+            self._size += 1
+            if not await self._reserve(time.time()):
+                continue
+            proc = await self._spawn()
+            async with self.cond:
+                self._idle.append((time.time(), proc))
+                self.cond.notify()
+
+    async def checkout(self, timeout=None):
+        """
+        Return an idle process, opening a new one if the pool is not
+        full, or else wait until one is checked in.
+
+        As for acepool.AcePool.checkout(), AcePoolBusy is raised after
+        waiting *timeout* seconds, or if *maxqueue* checkouts are
+        already waiting.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            dead = []
+            queued = False
+            try:
+                async with self.cond:
+                    proc = self._claim(dead, queued)
+                    while proc is self.WAIT:
+                        queued = True
+                        await _wait(self.cond, deadline)
+                        proc = self._claim(dead, queued)
+            finally:
+                if queued:
+                    self._waiting -= 1
+                for dead_proc in dead:
+                    logging.warning('Discarding dead ACE process: %r', self)
+                    await self._kill(dead_proc)
+            if proc is not self.NEW:
+                return proc
+            if await self._reserve(deadline):
+                return await self._spawn()
+
+    async def checkin(self, proc, discard=False):
+        """
+        Return *proc* to the pool, or close it if *discard* is `True`
+        or it is no longer running. A replacement is opened in the
+        background if the pool has fallen below *minsize*.
+        """
+        async with self.cond:
+            keep = self._put_back(proc, discard)
+            replenish = not keep and self._below_minimum()
+            self.cond.notify()
+        if keep:
+            if self.registry is not None:
+                await self.registry._notify()
+            return
+        await self._kill(proc)
+        if replenish:
+            asyncio.ensure_future(self._replenish())
+
+    def process(self, timeout=None):
+        """
+        Check out a process for the duration of an `async with` block.
+
+        *timeout* is as for checkout(). If the block raises an
+        exception (including cancellation), the process is in an
+        unknown state so it is discarded rather than returned to the
+        pool.
+        """
+        return _CheckedOut(self, timeout)
+
+    async def close(self):
+        """Close idle processes; others are closed when checked in."""
+        async with self.cond:
+            idle = self._close_idle()
+            self.cond.notify_all()
+        for proc in idle:
+            await proc.close()
+            if self.registry is not None:
+                await self.registry._release()
+
+    async def _reserve(self, deadline):
+        # as acepool.AcePool._reserve()
+        try:
+            if self.registry is None or await self.registry._reserve(
+                    self, deadline):
+                return True
+        except BaseException:
+            async with self.cond:
+                self._size -= 1
+                self.cond.notify()
+            raise
+        async with self.cond:
+            self._size -= 1
+        return False
+
+    async def _replenish(self):
+        try:
+            await self.start()
+        except Exception:
+            logging.exception('Could not restart ACE process: %r', self)
+
+    async def _spawn(self):
+        logging.info('Starting ACE: %r', self)
+        try:
+            return await self.cls(self.grm, **self.kwargs).open()
+        except BaseException:
+            async with self.cond:
+                self._size -= 1
+                self.cond.notify()
+            if self.registry is not None:
+                await self.registry._release()
+            raise
+
+    async def _kill(self, proc):
+        try:
+            await proc.kill()
+        except Exception:
+            logging.exception('Could not kill ACE process.')
+        if self.registry is not None:
+            await self.registry._release()
+
+
+class AsyncAceRegistry(BaseRegistry):
+    """
+    Pools of ACE processes keyed by grammar and command-line options.
+
+    Like acepool.AceRegistry: the total number of processes open
+    across all pools is kept at or below *maxprocs*, and when a new
+    process is needed at the limit, the least-recently-used idle
+    process is closed to make room. It must be used from a single
+    event loop; see ThreadedAceRegistry for use from other threads.
+    """
+
+    _pool_class = AsyncAcePool
+
+    def __init__(self, maxprocs=8):
+        BaseRegistry.__init__(self, maxprocs)
+        self._cond = None  # created in the event loop on first use
+
+    @property
+    def cond(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    def pool(self, cls, grm, cmdargs=None, minsize=0, maxsize=4,
+             maxqueue=None, version=None, **kwargs):
+        """
+        Return the pool for *cls* on *grm* with *cmdargs*.
+
+        As for acepool.AceRegistry.pool(), the pool is created if it
+        does not exist yet, and the pools for other *version*s of
+        *grm* are closed (in the background) when it is.
+        """
+        pool, stale = self._find_pool(
+            cls, grm, cmdargs, version, minsize=minsize, maxsize=maxsize,
+            maxqueue=maxqueue, **kwargs
+        )
+        for old in stale:
+            logging.info('Closing ACE processes for a replaced grammar: %r',
+                         old)
+            asyncio.ensure_future(old.close())
+        return pool
+
+    def pools(self):
+        return list(self._pools.values())
+
+    async def close(self):
+        """Close and forget all pools."""
+        pools = list(self._pools.values())
+        self._pools.clear()
+        for pool in pools:
+            await pool.close()
+
+    async def _reserve(self, pool, deadline):
+        # as acepool.AceRegistry._reserve()
+        async with self.cond:
+            room = self._make_room(pool)
+            while room is BasePool.WAIT:
+                await _wait(self.cond, deadline)
+                room = self._make_room(pool)
+        if room is False:
+            return False
+        if room is not None:
+            logging.debug('Evicting idle ACE process for: %r', pool)
+            try:
+                await room.kill()
+            except Exception:
+                logging.exception('Could not kill ACE process.')
+        return True
+
+    def _locked(self, pool):
+        # the event loop runs one thing at a time, so the state of a
+        # pool cannot change while it is not awaited
+        return contextlib.nullcontext()
+
+    async def _release(self):
+        async with self.cond:
+            self._total -= 1
+            self.cond.notify()
+
+    async def _notify(self):
+        async with self.cond:
+            self.cond.notify()
+
+
+class ThreadedAceRegistry(object):
+    """
+    The acepool.AceRegistry interface to an AsyncAceRegistry, for
+    threads other than its event loop's.
+
+    The pools given out are acepool.AcePool objects whose processes
+    are checked out of *registry*'s pools and talked to through *loop*,
+    so threads share the processes (and the limit on their number)
+    with the requests served by the event loop. AceParser and
+    AceGenerator pools use AsyncAceParser and AsyncAceGenerator
+    processes. None of the methods may be called from *loop*'s thread.
+    """
+
+    _classes = {AceParser: AsyncAceParser, AceGenerator: AsyncAceGenerator}
+
+    def __init__(self, registry, loop):
+        self.registry = registry
+        self.loop = loop
+
+    def __repr__(self):
+        return '<{} for {!r} at {}>'.format(
+            self.__class__.__name__, self.registry, id(self)
+        )
+
+    @property
+    def maxprocs(self):
+        return self.registry.maxprocs
+
+    def pool(self, cls, grm, cmdargs=None, **kwargs):
+        """As for acepool.AceRegistry.pool()."""
+        async def get():
+            return self.registry.pool(self._classes.get(cls, cls), grm,
+                                      cmdargs, **kwargs)
+        return _ThreadedAcePool(self, self._call(get()))
+
+    def pools(self):
+        async def get():
+            return self.registry.pools()
+        return [_ThreadedAcePool(self, pool) for pool in self._call(get())]
+
+    def close(self):
+        """Close and forget all pools, unless the loop has stopped."""
+        if not self.loop.is_closed():
+            self._call(self.registry.close())
+
+    def _call(self, coro):
+        # run *coro* in the loop and wait for its result
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+class _ThreadedAcePool(AcePool):
+    # an acepool.AcePool whose processes come from the AsyncAcePool
+    # *pool*, for the threads of the ThreadedAceRegistry *registry*;
+    # everything but checking processes out and in (e.g., batches with
+    # interact_many()) is AcePool's
+
+    def __init__(self, registry, pool):
+        AcePool.__init__(self, pool.cls, pool.grm, minsize=pool.minsize,
+                         maxsize=pool.maxsize, registry=registry,
+                         maxqueue=pool.maxqueue, **pool.kwargs)
+        self.pool = pool
+
+    def __repr__(self):
+        return '<{} for {!r}>'.format(self.__class__.__name__, self.pool)
+
+    def start(self):
+        self.registry._call(self.pool.start())
+
+    def checkout(self, timeout=None):
+        proc = self.registry._call(self.pool.checkout(timeout=timeout))
+        return _ThreadedProcess(proc, self.registry.loop)
+
+    def checkin(self, proc, discard=False):
+        self.registry._call(self.pool.checkin(proc.proc, discard=discard))
+
+    def health_check(self):
+        self.start()
+
+    def close(self):
+        self.registry._call(self.pool.close())
+
+
+class _ThreadedProcess(object):
+    # an AsyncAceProcess used from another thread than its event
+    # loop's, like a minidelphin.AceProcess
+
+    def __init__(self, proc, loop):
+        self.proc = proc
+        self.loop = loop
+
+    def __repr__(self):
+        return '<{} for {!r}>'.format(self.__class__.__name__, self.proc)
+
+    def send(self, datum):
+        self._call(self.proc.send(datum))
+
+    def receive(self):
+        return self._call(self.proc.receive())
+
+    def interact(self, datum):
+        return self._call(self.proc.interact(datum))
+
+    def is_alive(self):
+        return self.proc.is_alive()
+
+    def at_eof(self):
+        return self.proc.at_eof()
+
+    def abort(self):
+        # from any thread (e.g., a Watchdog's), without waiting
+        self.loop.call_soon_threadsafe(self.proc.abort)
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+async def _wait(cond, deadline):
+    # wait on *cond* (held) until notified, or raise AcePoolBusy once
+    # *deadline* (if not None) has passed
+    timeout = None if deadline is None else deadline - time.time()
+    try:
+        await asyncio.wait_for(cond.wait(), timeout)
+    except asyncio.TimeoutError:
+        raise AcePoolBusy('Timed out waiting for an ACE process.')
+
+
+class _CheckedOut(object):
+
+    def __init__(self, pool, timeout=None):
+        self.pool = pool
+        self.timeout = timeout
+        self.proc = None
+
+    async def __aenter__(self):
+        self.proc = await self.pool.checkout(timeout=self.timeout)
+        return self.proc
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.pool.checkin(self.proc, discard=exc_type is not None)
+        return False
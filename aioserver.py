@@ -0,0 +1,549 @@
+#!/usr/bin/env python3
+
+#
+# aioserver : an asyncio server for Demophin
+#
+# Parse and generation requests wait on ACE with asyncio (see aioace),
+# so one thread serves any number of concurrent users with the ACE
+# processes shared among them. Every other request (pages, static
+# files, batches, statistics) is passed to the Bottle application in
+# demophin.py, which runs on a small pool of threads. Its batches use
+# the same ACE processes, through aioace.ThreadedAceRegistry, so one
+# limit on their number covers both.
+#
+# Usage: python3 aioserver.py [--host HOST] [--port PORT] [-v]
+#
+# This module requires Python 3.7 or later.
+
+import io
+import os
+import re
+import sys
+import json
+import logging
+import argparse
+import asyncio
+import tempfile
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+from bottle import BaseRequest
+
+import demophin
+from demophin import (
+    app, grammars, ace_options, result_cache, preprocess_input,
+    parse_options, parse_key, finish_parse, generate_key, finish_generate,
+    wants_mrs, without_mrs, time_budget, timed_out, BUDGET_HEADER,
+    queue_options, retry_after, limit_nresults, grammar_version
+)
+from minidelphin import AceParserReader, AceGeneratorReader
+from acepool import AcePoolError, AcePoolBusy, normalize_cmdargs
+from aioace import (
+    AsyncAceParser, AsyncAceGenerator, AsyncAceRegistry, ThreadedAceRegistry
+)
+from resultcache import SingleFlight
+
+# requests handled without the Bottle application
+ACE_ROUTE = re.compile(r'^/([^/]+)/(parse|generate)$')
+
+STATUS_LINES = {
+    200: '200 OK',
+    400: '400 Bad Request',
+    413: '413 Payload Too Large',
+    431: '431 Request Header Fields Too Large',
+    500: '500 Internal Server Error',
+    501: '501 Not Implemented',
+    503: '503 Service Unavailable'
+}
+
+# limits on request headers, beyond which a request is refused
+MAX_HEADERS = 100
+MAX_HEADER_BYTES = 65536
+
+executor = None  # threads for the Bottle application and CPU-bound work
+
+# as demophin.ace_registry, which serve() replaces with a bridge to this
+ace_registry = AsyncAceRegistry(
+    maxprocs=app.config.get('demophin.ace.pool.max_processes', 8)
+)
+
+
+def ace_pool(cls, grm, cmdargs, keep_open=False, version=None):
+    # as demophin.ace_pool(), but for asyncio processes
+    if version is None:
+        version = grammar_version(grm)
+    poolcfg = {
+        'min': app.config.get('demophin.ace.pool.min', 1),
+        'max': app.config.get('demophin.ace.pool.max', 4)
+    }
+    poolcfg.update(grm.get('pool', {}))
+    return ace_registry.pool(
+        cls, grm['path'], cmdargs,
+        minsize=poolcfg['min'] if keep_open else 0,
+        maxsize=poolcfg['max'],
+        maxqueue=queue_options(grm)['depth'], version=version,
+        executable=ace_options['executable'], env=ace_options['env']
+    )
+
+
+class AsyncSingleFlight(SingleFlight):
+    """
+    A SingleFlight that also coalesces calls made with do_async().
+
+    Calls made with do() and do_async() are counted together, so one
+    instance (shared with demophin for /_stats) reports both.
+    """
+
+    def __init__(self):
+        SingleFlight.__init__(self)
+        self._tasks = {}  # key: task computing the result
+
+    async def do_async(self, key, func):
+        """
+        Return the result of awaiting func(), or of the call for *key*
+        that is already running.
+
+        The call runs as its own task, so it is finished for the other
+        callers (and cached) even if the one that started it is
+        cancelled.
+        """
+        task = self._tasks.get(key)
+        with self._lock:
+            if task is None:
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if task is None:
+            task = self._tasks[key] = asyncio.ensure_future(func())
+            task.add_done_callback(functools.partial(self._land, key))
+        return await asyncio.shield(task)
+
+    def _land(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            task.exception()  # retrieved, even if no caller is waiting
+
+    def stats(self):
+        stats = SingleFlight.stats(self)
+        stats['active'] += len(self._tasks)
+        return stats
+
+
+in_flight = AsyncSingleFlight()
+
+
+async def start_pools():
+    # open processes for the default options of each grammar, as
+    # demophin.start_pools() does for the threaded server
+    for grm in grammars.values():
+        if not os.path.isfile(grm.get('path', '')):
+            continue
+        for pool in (
+                ace_pool(AsyncAceParser, grm, demophin.parser_cmdargs(grm),
+                         True),
+                ace_pool(AsyncAceGenerator, grm, ace_options['cmdargs'],
+                         True)):
+            try:
+                await pool.start()
+            except (OSError, ValueError, AcePoolError) as e:
+                logging.error("Could not start ACE (Error = %s)" % (e,))
+
+
+async def close_pools():
+    await ace_registry.close()
+
+
+async def in_thread(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args))
+
+
+async def parse(grm, forms, budget=None):
+    sent = forms.get('sentence')
+    n = limit_nresults(grm, forms.get('nresults', 5))
+    parse_input = await in_thread(preprocess_input, grm, sent)
+    result = await parse_sentence(grm, parse_input, n=n, budget=budget)
+    if not wants_mrs(forms):
+        result = without_mrs(result)
+    return {
+        'sentence': '' if sent is None else sent,
+        'nresults': n,
+        'result': result
+    }
+
+
+async def parse_sentence(grm, sent, n=None, budget=None):
+    # as demophin.parse_sentence()
+    if not sent:
+        return None
+    n, cmdargs = parse_options(grm, n)
+    version = grammar_version(grm)
+    key = parse_key(grm, sent, n, cmdargs, version)
+    # the cache may be an SQLite database, which can block
+    result = await in_thread(result_cache.get, key)
+    if result is not None:
+        return result
+
+    async def run():
+        logging.debug("Calling ACE using these opts: %s" % (cmdargs,))
+        wait = queue_options(grm)['max_wait']
+        pool = ace_pool(AsyncAceParser, grm, cmdargs, version=version)
+        async with pool.process(timeout=wait) as parser:
+            result = await interact(parser, sent, budget)
+            complete = parser.is_alive()  # partial if ACE died
+        return await in_thread(finish_parse, key, result, n, complete)
+
+    return await in_flight.do_async(key + (budget,), run)
+
+
+async def generate(grm, forms, budget=None):
+    # as demophin.generate_sentences()
+    mrs = forms.get('mrs')
+    if not mrs:
+        return None
+    cmdargs = normalize_cmdargs(ace_options['cmdargs'])
+    version = grammar_version(grm)
+    key = await in_thread(generate_key, grm, mrs, cmdargs, version)
+    result = await in_thread(result_cache.get, key)
+    if result is not None:
+        return result
+
+    async def run():
+        wait = queue_options(grm)['max_wait']
+        pool = ace_pool(AsyncAceGenerator, grm, cmdargs, version=version)
+        async with pool.process(timeout=wait) as gen:
+            result = await interact(gen, mrs, budget)
+            complete = gen.is_alive()  # partial if ACE died
+        return await in_thread(finish_generate, key, result, complete)
+
+    return await in_flight.do_async(key + (budget,), run)
+
+
+async def interact(proc, datum, budget):
+    # as proc.interact(datum), but if ACE takes longer than *budget*
+    # seconds it is killed (and replaced when the pool gets it back)
+    # and the result says it timed out
+    try:
+        return await asyncio.wait_for(proc.interact(datum), budget)
+    except asyncio.TimeoutError:
+        logging.warning('ACE took longer than %g seconds; stopping it: %r',
+                        budget, proc)
+        await proc.kill()
+        reader = (AceParserReader if isinstance(proc, AsyncAceParser)
+                  else AceGeneratorReader)
+        return timed_out(reader().finish(), budget)
+
+
+async def ace_request(environ, grm, action):
+    # the parse or generate form request in *environ*
+    forms = await in_thread(lambda: BaseRequest(environ).forms)
+    header = environ.get('HTTP_' + BUDGET_HEADER.upper().replace('-', '_'))
+    try:
+        budget = time_budget(grm, header)
+    except ValueError:
+        return text_response(400, 'Invalid %s: %s' % (BUDGET_HEADER, header))
+    if action == 'parse':
+        n = forms.get('nresults', 5)
+        try:
+            int(n)
+        except ValueError:
+            return text_response(400, 'Invalid nresults: %s' % n)
+    handler = parse if action == 'parse' else generate
+    try:
+        result = await handler(grm, forms, budget=budget)
+    except AcePoolBusy as e:
+        # as demophin.overloaded()
+        logging.warning('Refusing request: %s', e)
+        status, headers, body = text_response(
+            503, 'The server is busy. Please try again later.'
+        )
+        headers.append(('Retry-After', str(retry_after())))
+        return status, headers, body
+    if result is None:
+        return 200, [('Content-Type', 'text/html; charset=UTF-8')], b''
+    body = json.dumps(result).encode('utf-8')
+    return 200, [('Content-Type', 'application/json')], body
+
+
+def text_response(status, text):
+    return (status, [('Content-Type', 'text/plain; charset=UTF-8')],
+            text.encode('utf-8'))
+
+
+def ace_route(environ):
+    # the grammar and action if the request is a parse or generate
+    # request for a configured grammar, otherwise None so the Bottle
+    # application can respond (e.g., with its 404 page)
+    if environ['REQUEST_METHOD'] != 'POST':
+        return None
+    match = ACE_ROUTE.match(environ['PATH_INFO'])
+    if match is None:
+        return None
+    grm = grammars.get(match.group(1).lower())
+    if grm is None or not os.path.exists(grm.get('path')):
+        return None
+    return grm, match.group(2)
+
+
+async def call_app(environ, writer, keep_alive):
+    # run the Bottle application in a thread, writing its output to
+    # *writer* as it is produced; return True if the connection may be
+    # kept open
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue(maxsize=16)
+    started = {}
+    stopped = []  # nonempty once the output is no longer wanted
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = status
+        started['headers'] = headers
+
+    def put(chunk):
+        if stopped:
+            raise ConnectionError('The client disconnected.')
+        asyncio.run_coroutine_threadsafe(chunks.put(chunk), loop).result()
+
+    def run():
+        # Bottle's request and response are thread-local, so the
+        # application is called and its output iterated in one thread
+        try:
+            output = app(environ, start_response)
+            try:
+                for chunk in output:
+                    put(chunk)
+            finally:
+                if hasattr(output, 'close'):
+                    output.close()
+        finally:
+            if not stopped:
+                put(None)
+
+    done = loop.run_in_executor(executor, run)
+    try:
+        chunk = await chunks.get()
+        headers = list(started['headers'])
+        names = set(name.lower() for name, _ in headers)
+        chunked = 'content-length' not in names and not (
+            environ['REQUEST_METHOD'] == 'HEAD' or
+            started['status'][:3] in ('204', '304')  # no body
+        )
+        if chunked:
+            if environ['SERVER_PROTOCOL'] == 'HTTP/1.1':
+                headers.append(('Transfer-Encoding', 'chunked'))
+            else:
+                keep_alive = chunked = False  # end of body is end of stream
+        write_head(writer, started['status'], headers, keep_alive)
+        while chunk is not None:
+            if chunk:
+                if chunked:
+                    writer.write(b'%x\r\n' % len(chunk))
+                writer.write(chunk)
+                if chunked:
+                    writer.write(b'\r\n')
+                await writer.drain()
+            chunk = await chunks.get()
+        if chunked:
+            writer.write(b'0\r\n\r\n')
+    finally:
+        stopped.append(True)
+        while not chunks.empty():
+            chunks.get_nowait()  # unblock the thread so it can stop
+    await done
+    return keep_alive
+
+
+def write_head(writer, status, headers, keep_alive):
+    lines = ['HTTP/1.1 ' + status]
+    lines.extend('%s: %s' % (name, value) for name, value in headers)
+    lines.append('Connection: ' + ('keep-alive' if keep_alive else 'close'))
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+
+class BadRequest(Exception):
+    # a request that is refused with *status*, closing the connection
+    # since the rest of it may not have been read
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+async def read_request(reader, server):
+    # the WSGI environ for the next request, without its body (see
+    # read_body()), or None at end of stream
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    try:
+        method, target, protocol = line.decode('latin-1').split()
+    except ValueError:
+        raise BadRequest(400, 'Malformed request line.')
+    path, _, query = target.partition('?')
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': unquote(path, 'latin-1'),
+        'QUERY_STRING': query,
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': protocol,
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    size = 0
+    for count in range(MAX_HEADERS + 1):
+        line = await reader.readline()
+        size += len(line)
+        line = line.decode('latin-1').rstrip('\r\n')
+        if not line:
+            break
+        if size > MAX_HEADER_BYTES or count == MAX_HEADERS:
+            raise BadRequest(431, 'Request headers are too large.')
+        name, _, value = line.partition(':')
+        name = name.strip().upper().replace('-', '_')
+        value = value.strip()
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+        else:
+            key = 'HTTP_' + name
+            if key in environ:
+                value = environ[key] + ',' + value
+            environ[key] = value
+    if environ.get('HTTP_TRANSFER_ENCODING', 'identity') != 'identity':
+        # chunked bodies are not supported, and the request cannot be
+        # skipped without reading them
+        raise BadRequest(501, 'Transfer-Encoding is not supported.')
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise BadRequest(400, 'Invalid Content-Length.')
+    return environ
+
+
+async def read_body(reader, environ, limit=None):
+    # read the body of the request in *environ* into its wsgi.input;
+    # as with Bottle, large bodies are kept in a temporary file, and
+    # bodies of more than *limit* bytes are refused
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    if limit is not None and length > limit:
+        raise BadRequest(413, 'Request body is too large.')
+    if length <= BaseRequest.MEMFILE_MAX:
+        body = io.BytesIO(await reader.readexactly(length) if length else b'')
+    else:
+        body = tempfile.TemporaryFile()
+        while length:
+            chunk = await reader.readexactly(min(length, 65536))
+            await in_thread(body.write, chunk)
+            length -= len(chunk)
+        body.seek(0)
+    environ['wsgi.input'] = body
+
+
+def refuse(writer, status, text):
+    # respond to a request that was not read completely, which ends
+    # the connection
+    status, headers, body = text_response(status, text)
+    headers.append(('Content-Length', str(len(body))))
+    write_head(writer, STATUS_LINES[status], headers, False)
+    writer.write(body)
+
+
+def keeps_alive(environ):
+    connection = environ.get('HTTP_CONNECTION', '').lower()
+    if environ['SERVER_PROTOCOL'] == 'HTTP/1.1':
+        return connection != 'close'
+    return connection == 'keep-alive'
+
+
+async def handle_connection(reader, writer):
+    server = writer.get_extra_info('sockname')[:2]
+    peer = writer.get_extra_info('peername')
+    try:
+        while True:
+            try:
+                environ = await read_request(reader, server)
+                if environ is None:
+                    break
+                route = ace_route(environ)
+                # parse and generate forms are read whole, as by Bottle
+                await read_body(reader, environ,
+                                None if route is None
+                                else BaseRequest.MEMFILE_MAX)
+            except BadRequest as e:
+                refuse(writer, e.status, str(e))
+                break
+            except (ValueError, asyncio.IncompleteReadError):
+                refuse(writer, 400, 'Malformed request.')
+                break
+            if peer:
+                environ['REMOTE_ADDR'] = peer[0]
+            keep_alive = keeps_alive(environ)
+            if route is None:
+                keep_alive = await call_app(environ, writer, keep_alive)
+            else:
+                try:
+                    status, headers, body = await ace_request(environ, *route)
+                except Exception:
+                    logging.exception('Error handling %s', environ['PATH_INFO'])
+                    status, headers, body = 500, [], b''
+                headers.append(('Content-Length', str(len(body))))
+                write_head(writer, STATUS_LINES[status], headers, keep_alive)
+                writer.write(body)
+            await writer.drain()
+            environ['wsgi.input'].close()
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host, port):
+    # batches and /_stats in the Bottle application share the processes
+    # and the calls in flight
+    demophin.ace_registry = ThreadedAceRegistry(
+        ace_registry, asyncio.get_running_loop()
+    )
+    demophin.in_flight = in_flight
+    await start_pools()
+    server = await asyncio.start_server(handle_connection, host, port)
+    logging.info('Demophin listening on http://%s:%d/', host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await close_pools()
+
+
+def main(args=None):
+    global executor
+    parser = argparse.ArgumentParser(
+        description='Serve Demophin with asyncio.'
+    )
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--threads', type=int, default=8,
+                        help='threads for requests other than parse and '
+                             'generate (default: 8)')
+    parser.add_argument('-v', action='store_true', help='debug logging')
+    args = parser.parse_args(args)
+    logging.basicConfig(level=logging.DEBUG if args.v else logging.INFO)
+    executor = ThreadPoolExecutor(max_workers=args.threads)
+    demophin.load_preprocessors()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+
+#
+# Decoding speed of SimpleMRS: loads_one() against the single-pass
+# fast_loads_one(), on the synthetic corpus (200 MRSs of 20-40 EPs).
+# Both must give equal Xmrs objects; then each is timed as the best of
+# several repeats. For comparison, two lower bounds on any decoder
+# built on these regular expressions are shown: scanning alone, and
+# scanning plus building the EP tuples with no Xmrs or variable index.
+# The second is itself only about 3x faster than loads_one(), which is
+# why that target for fast_loads_one() was withdrawn.
+#
+# Usage: python benchmarks/bench_loads.py
+
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [here, os.path.join(here, os.pardir)]
+
+import minidelphin as md
+from corpus import corpus
+
+
+def best(func, number=3, repeat=7):
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def eps_only(string):
+    # the EPs of *string* as fast_loads_one() builds them, and nothing
+    # else; *string* must be well-formed
+    match = md._mrs_head_re.match(string)
+    eps = []
+    nid = 10000
+    get_pred = md.pred_cache.get
+    args_findall = md._arg_re.findall
+    for match in md._ep_re.finditer(string, match.end()):
+        predstr, cfrom, cto, surface, label, argstr = match.groups()
+        eps.append((
+            nid, get_pred(predstr), label,
+            dict((role, val) for role, val, _ in args_findall(argstr)),
+            None if cfrom is None else (0, (int(cfrom), int(cto))),
+            surface
+        ))
+        nid += 1
+    return eps
+
+
+def main():
+    mrss = corpus()
+    for s in mrss:
+        assert md.loads_one(s) == md.fast_loads_one(s)
+    slow = best(lambda: [md.loads_one(s) for s in mrss])
+    fast = best(lambda: [md.fast_loads_one(s) for s in mrss])
+    scan = best(lambda: [md._ep_re.findall(s) for s in mrss])
+    eps = best(lambda: [eps_only(s) for s in mrss])
+    print('{} MRSs'.format(len(mrss)))
+    print('loads_one       {:.4f}s'.format(slow))
+    print('fast_loads_one  {:.4f}s  ({:.1f}x)'.format(fast, slow / fast))
+    print('  EP regex only {:.4f}s  ({:.1f}x)'.format(scan, slow / scan))
+    print('  EPs only      {:.4f}s  ({:.1f}x)'.format(eps, slow / eps))
+
+
+if __name__ == '__main__':
+    main()
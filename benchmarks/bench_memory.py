@@ -0,0 +1,53 @@
+
+#
+# Memory per MRS of Xmrs against CompactXmrs, on the synthetic corpus
+# (300 MRSs of 20-40 EPs), as traced by tracemalloc while all of them
+# are kept alive. The CompactXmrs figure counts only the compacted
+# objects; the Xmrs each was made from is freed. The Preds, which both
+# share through minidelphin.pred_cache, are loaded beforehand so that
+# neither count includes them.
+#
+# Usage: python3 benchmarks/bench_memory.py (tracemalloc needs Python 3)
+
+from __future__ import print_function
+
+import os
+import gc
+import sys
+import tracemalloc
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [here, os.path.join(here, os.pardir)]
+
+import minidelphin as md
+from corpus import corpus
+
+
+def measure(func, mrss):
+    # traced bytes per MRS held after applying *func* to each of *mrss*
+    gc.collect()
+    tracemalloc.start()
+    kept = [func(s) for s in mrss]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert len(kept) == len(mrss)
+    return size / len(mrss)
+
+
+def main():
+    mrss = corpus(300)
+    for s in mrss:
+        x = md.fast_loads_one(s)
+        assert md.CompactXmrs.from_xmrs(x) == x
+    full = measure(md.fast_loads_one, mrss)
+    compact = measure(
+        lambda s: md.CompactXmrs.from_xmrs(md.fast_loads_one(s)), mrss
+    )
+    print('{} MRSs'.format(len(mrss)))
+    print('Xmrs         {:8.0f} bytes per MRS'.format(full))
+    print('CompactXmrs  {:8.0f} bytes per MRS  ({:.1f}x smaller)'
+          .format(compact, full / compact))
+
+
+if __name__ == '__main__':
+    main()
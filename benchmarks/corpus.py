@@ -0,0 +1,69 @@
+
+#
+# Synthetic ERG-style SimpleMRS for the benchmarks: quantifiers with
+# qeqs, nouns with full properties, verbs and modifiers with event
+# properties and ARG1/ARG2, CARGs, and some quoted predicates.
+#
+# corpus(n, neps, seed) gives *n* MRSs of neps/2 to neps EPs each; the
+# same arguments always give the same corpus.
+
+import random
+
+PREDS = ['_the_q', '_dog_n_1', '_bark_v_1', '_cat_n_1', '_chase_v_1',
+         'udef_q', 'compound', '_big_a_1', '_in_p', '_park_n_1',
+         'proper_q', 'named', '_quickly_a_1', '_and_c', 'pron', 'pronoun_q',
+         '_say_v_to', '_that_q_dem', '_every_q', '_house_n_of']
+
+
+def make_mrs(rng, neps):
+    vid = [1]
+
+    def new(s):
+        vid[0] += 1
+        return '%s%d' % (s, vid[0])
+
+    eps = []
+    hcons = []
+    xs = []
+    es = []
+    for i in range(neps):
+        pred = rng.choice(PREDS)
+        lbl = new('h')
+        cfrom = i * 5
+        lnk = '<%d:%d>' % (cfrom, cfrom + 4)
+        if pred.endswith('_q') or pred.endswith('_q_dem'):
+            x = rng.choice(xs) if xs else new('x')
+            r, b = new('h'), new('h')
+            hcons.append((r, 'qeq', new('h')))
+            args = 'ARG0: %s RSTR: %s BODY: %s' % (x, r, b)
+            pred = pred + '_rel'
+        elif '_n_' in pred or pred in ('named', 'pron'):
+            x = new('x')
+            xs.append(x)
+            args = 'ARG0: %s [ x PERS: 3 NUM: sg IND: + ]' % x
+            if pred == 'named':
+                args += ' CARG: "Kim"'
+            pred = pred + '_rel'
+        else:
+            e = new('e')
+            es.append(e)
+            args = ('ARG0: %s [ e SF: prop TENSE: pres MOOD: indicative '
+                    'PROG: - PERF: - ]' % e)
+            if xs:
+                args += ' ARG1: %s' % rng.choice(xs)
+            if len(xs) > 1:
+                args += ' ARG2: %s' % rng.choice(xs)
+            pred = pred + '_rel'
+        if rng.random() < 0.2:
+            pred = '"%s"' % pred
+        eps.append('[ %s%s LBL: %s %s ]' % (pred, lnk, lbl, args))
+    hcons.append(('h0', 'qeq', 'h1'))
+    index = es[0] if es else 'e2'
+    return ('[ TOP: h0 INDEX: %s [ e SF: prop TENSE: pres MOOD: indicative ] '
+            'RELS: < %s > HCONS: < %s > ICONS: < > ]'
+            % (index, ' '.join(eps), ' '.join(' '.join(hc) for hc in hcons)))
+
+
+def corpus(n=200, neps=40, seed=1):
+    rng = random.Random(seed)
+    return [make_mrs(rng, rng.randint(neps // 2, neps)) for _ in range(n)]
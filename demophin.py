@@ -1,27 +1,41 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import sys
 import os
 import json
+import atexit
 import logging
-
-# LTA 2016-05-12
-import importlib
-
-def preprocess(sent, processor_name):
-    try:
-        i = importlib.import_module(processor_name)
-        return i.get_ace_input(sent)
-    except Exception as e:
-        logging.error("Preprocessor cannot be used (Error = %s)" % (e,))
-        pass
+import argparse
+import threading
+from collections import deque
+from itertools import islice
+from wsgiref.simple_server import WSGIServer
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+try:
+    text_type = unicode
+except NameError:  # Python 3
+    text_type = str
 
 from bottle import (
-    abort, error, default_app, redirect, request, route, run, static_file, view
+    abort, error, default_app, redirect, request, response, route, run,
+    static_file, view, HTTPError, ServerAdapter
 )
 
-from minidelphin import loads_one, nodes, links, AceParser, AceGenerator
+from minidelphin import (
+    fast_loads_one, fast_dumps_one, fast_nodes_and_links, canonicalize,
+    AceParser, AceGenerator, interact_from_iterable, pred_cache
+)
+from acepool import (
+    AceRegistry, AcePoolError, AcePoolBusy, Watchdog, TIMED_OUT,
+    normalize_cmdargs
+)
+from resultcache import MemoryCache, SqliteCache, TieredCache, SingleFlight
+from preprocessors import PreprocessorRegistry
 
 app = default_app()
 
@@ -38,10 +52,38 @@ ace_options = {
     'env': ace_env
 }
 
+# clients may ask for a different time budget (in seconds) per item
+BUDGET_HEADER = 'X-Demophin-Timeout'
+
 grammars = {}
 for gramdata in app.config['demophin.grammars']:
     grammars[gramdata['name'].lower()] = gramdata
 
+# long-lived ACE processes, pooled by grammar and ACE options
+ace_registry = AceRegistry(
+    maxprocs=app.config.get('demophin.ace.pool.max_processes', 8)
+)
+
+# processed results, keyed by grammar version, input, and ACE options
+result_cache = MemoryCache(
+    maxbytes=app.config.get('demophin.cache.maxbytes', 64 * 1024 * 1024),
+    ttl=app.config.get('demophin.cache.ttl')
+)
+if app.config.get('demophin.cache.sqlite.path'):
+    result_cache = TieredCache(result_cache, SqliteCache(
+        os.path.join(cwd, app.config['demophin.cache.sqlite.path']),
+        maxbytes=app.config.get('demophin.cache.sqlite.maxbytes',
+                                1024 * 1024 * 1024),
+        ttl=app.config.get('demophin.cache.ttl'),
+        interval=app.config.get('demophin.cache.sqlite.interval', 60)
+    ))
+
+# parses and generations under way, shared by identical requests
+in_flight = SingleFlight()
+
+# input preprocessors (e.g., pyjacy), loaded by load_preprocessors()
+preprocessors = PreprocessorRegistry()
+
 @route('/static/<filepath:path>')
 def server_static(filepath):
     return static_file(filepath, root=os.path.join(cwd, 'static'))
@@ -56,6 +98,15 @@ def index():
     }
 
 
+@route('/_stats')
+def stats():
+    return {
+        'cache': result_cache.stats(),
+        'preds': pred_cache.stats(),
+        'in_flight': in_flight.stats()
+    }
+
+
 @route('/<grmkey>')
 def bare_grmkey(grmkey):
     redirect('%s/' % grmkey)
@@ -80,13 +131,15 @@ def main(grmkey):
 def parse(grmkey):
     grm = get_grammar(grmkey)
     sent = request.forms.get('sentence')
-    n = request.forms.get('nresults', 5)
-    # use preprocessor if available
-    if grm.get('preprocessor'):
-        parse_input = preprocess(sent, grm.get('preprocessor'))
-    else:
-        parse_input = sent
-    result = parse_sentence(grm, parse_input, n=n)
+    n = limit_nresults(grm, read_nresults(request.forms))
+    budget = read_budget(grm)
+    parse_input = preprocess_input(grm, sent)
+    try:
+        result = parse_sentence(grm, parse_input, n=n, budget=budget)
+    except AcePoolBusy as e:
+        raise overloaded(e)
+    if not wants_mrs(request.forms):
+        result = without_mrs(result)
     return {
         'sentence': '' if sent is None else sent,
         'nresults': n,
@@ -94,6 +147,105 @@ def parse(grmkey):
     }
 
 
+@route('/<grmkey>/parse/batch', method='POST')
+def parse_batch(grmkey):
+    grm = get_grammar(grmkey)
+    n = read_nresults(request.query)
+    workers, ordered = read_batch_options()
+    budget = read_budget(grm)
+    sents = read_batch()
+    items = parse_sentences(grm, sents, n=n, workers=workers,
+                            ordered=ordered, budget=budget)
+    if not wants_mrs(request.query):
+        items = (dict(item, result=without_mrs(item['result']))
+                 for item in items)
+    return ndjson(shed_load(items))
+
+
+def read_batch_options():
+    # workers=N (or "auto", the default, for one per CPU) and
+    # order=input|completion
+    workers = request.query.get('workers', 'auto')
+    try:
+        workers = None if workers == 'auto' else int(workers)
+    except ValueError:
+        abort(400, 'Invalid number of workers: %s' % workers)
+    order = request.query.get('order', 'input')
+    if order not in ('input', 'completion'):
+        abort(400, 'Invalid order: %s' % order)
+    return workers, order == 'input'
+
+
+def read_nresults(params):
+    # the nresults parameter, which parse_options() limits
+    n = params.get('nresults', 5)
+    try:
+        int(n)
+    except ValueError:
+        abort(400, 'Invalid nresults: %s' % n)
+    return n
+
+
+def read_budget(grm):
+    # the time budget for each item of the request
+    try:
+        return time_budget(grm, request.get_header(BUDGET_HEADER))
+    except ValueError:
+        abort(400, 'Invalid %s: %s' % (BUDGET_HEADER,
+                                       request.get_header(BUDGET_HEADER)))
+
+
+def ndjson(items):
+    # one JSON object per line, sent as each becomes available
+    response.content_type = 'application/x-ndjson'
+    return (json.dumps(item) + '\n' for item in items)
+
+
+def read_batch():
+    # a JSON array of strings, which must be read whole and so is
+    # checked first (bad input is a 400); or one item per (non-blank)
+    # line, read as the batch is processed, with an InvalidInput for
+    # each line that cannot be decoded
+    if request.content_type.startswith('application/json'):
+        try:
+            items = json.loads(request.body.read().decode('utf-8'))
+        except ValueError as e:
+            abort(400, 'Invalid JSON: %s' % e)
+        if not isinstance(items, list):
+            abort(400, 'Expected a JSON array.')
+        if not all(isinstance(item, text_type) for item in items):
+            abort(400, 'Expected a JSON array of strings.')
+        return [item.strip() for item in items]
+    return read_lines(request.body)
+
+
+def read_lines(body):
+    for i, line in enumerate(body, 1):
+        try:
+            line = line.decode('utf-8').strip()
+        except UnicodeDecodeError:
+            yield InvalidInput('Line %d is not valid UTF-8.' % i)
+            continue
+        if line:
+            yield line
+
+
+class InvalidInput(object):
+    # an item of a batch that could not be read; it is falsy, like an
+    # empty input, so it is not preprocessed, and run_batch() gives it
+    # a result with *error* instead of preparing it
+
+    __slots__ = ('error',)
+
+    def __init__(self, error):
+        self.error = error
+
+    def __bool__(self):
+        return False
+
+    __nonzero__ = __bool__
+
+
 def get_grammar(grmkey):
     grmkey = grmkey.lower()  # normalize key
     if grmkey not in grammars:
@@ -104,40 +256,333 @@ def get_grammar(grmkey):
     return grm
 
 
-def parse_sentence(grm, sent, n=None):
-    if not sent:
-        return None
-    # update cmdargs as necessary
-    opts = dict(ace_options)
+def preprocess_input(grm, sent):
+    # use preprocessor if available
+    if sent and grm.get('preprocessor'):
+        return preprocessors.preprocess(sent, grm['preprocessor'])
+    return sent
+
+
+def preprocess_inputs(grm, sents, size=64):
+    # as preprocess_input(), for each of *sents*, yielding (sent, input)
+    # pairs; sentences are given to the preprocessor *size* at a time
+    name = grm.get('preprocessor')
+    if not name:
+        for sent in sents:
+            yield sent, sent
+        return
+    sents = iter(sents)
+    while True:
+        chunk = list(islice(sents, size))
+        if not chunk:
+            break
+        todo = [sent for sent in chunk if sent]
+        inputs = iter(preprocessors.preprocess_batch(todo, name))
+        for sent in chunk:
+            yield sent, next(inputs) if sent else sent
+
+
+def parser_cmdargs(grm, n=None):
     # use optional ACE args
-    if grm.get('aceopts'):
-        opts['cmdargs'] += grm.get('aceopts')
+    cmdargs = list(ace_options['cmdargs']) + list(grm.get('aceopts', []))
     # update n properly
     if n is not None:
-        for i in range(len(opts['cmdargs'])):
-            if opts['cmdargs'][i].startswith('-n '):
-                opts['cmdargs'][i] = '-n ' + str(n)
-    #  uniqify
-    opts['cmdargs'] = list(set(opts['cmdargs']))
-    logging.debug("Calling ACE using these opts: %s" % (opts['cmdargs'],))
-    # now try to get a parse
-    with AceParser(grm['path'], **opts) as parser:
-        result = parser.interact(sent)
+        cmdargs = ['-n ' + str(n) if arg.startswith('-n ') else arg
+                   for arg in cmdargs]
+    #  uniqify (sorted, so equivalent option sets compare equal)
+    return sorted(set(cmdargs))
+
+
+def max_results(cmdargs):
+    # the -n value in *cmdargs*, or None if the number is not limited
+    for arg in cmdargs:
+        if arg.startswith('-n '):
+            return int(arg[3:])
+    return None
+
+
+def parse_sentence(grm, sent, n=None, budget=None):
+    if not sent:
+        return None
+    n, cmdargs = parse_options(grm, n)
+    version = grammar_version(grm)
+    key = parse_key(grm, sent, n, cmdargs, version)
+    result = result_cache.get(key)
+    if result is not None:
+        return result
+
+    def run():
+        logging.debug("Calling ACE using these opts: %s" % (cmdargs,))
+        pool = ace_pool(AceParser, grm, cmdargs, version=version)
+        wait = queue_options(grm)['max_wait']
+        with pool.process(timeout=wait) as parser, \
+                Watchdog(parser, budget) as watchdog:
+            result = parser.interact(sent)
+            complete = parser.is_alive()  # partial if ACE died
+        if watchdog.expired:
+            result = timed_out(result, budget)
+        return finish_parse(key, result, n, complete)
+
+    # identical requests made while this one is parsed wait for it;
+    # the budget is part of the key as results that time out differ
+    return in_flight.do(key + (budget,), run)
+
+
+def parse_sentences(grm, sents, n=None, workers=None, ordered=True,
+                    budget=None):
+    """
+    Yield a dict with the result for each sentence in *sents*.
+
+    Sentences not in the cache are spread across *workers* ACE
+    processes (`None`, the default, for one per CPU), or streamed
+    through one if *workers* is 1; no process is used until a
+    sentence is not found in the cache. If *ordered* is `False`,
+    results are yielded as they complete rather than in the order of
+    *sents*. A sentence that takes longer than *budget* seconds gets
+    an error, and the rest continue on a new process.
+    """
+    n, cmdargs = parse_options(grm, n)
+    version = grammar_version(grm)
+    inputs = deque()  # preprocessed, one for each sentence given out
+
+    def sources():
+        for sent, parse_input in preprocess_inputs(grm, sents):
+            if not isinstance(sent, InvalidInput):
+                inputs.append(parse_input)
+            yield sent
+
+    def prepare(sent):
+        # run_batch() prepares each source as soon as it gets it
+        parse_input = inputs.popleft()
+        return parse_key(grm, parse_input, n, cmdargs, version), parse_input
+
+    return run_batch(
+        ace_pool(AceParser, grm, cmdargs, version=version),
+        interact_from_iterable, sources(),
+        prepare, lambda key, result: finish_parse(key, result, n, True),
+        workers=workers, ordered=ordered, budget=budget,
+        wait=queue_options(grm)['max_wait']
+    )
+
+
+def run_batch(pool, from_iterable, sources, prepare, finish,
+              workers=1, ordered=True, budget=None, wait=None):
+    # For each source, prepare(source) gives the cache key and ACE
+    # input, and finish(key, response) the result to return. Cache
+    # misses are streamed through processes from *pool* by
+    # *from_iterable*, waiting up to *wait* seconds for each process.
+    # An InvalidInput source is not prepared but gets its error.
+    cached = deque()  # hits found while feeding misses to ACE
+
+    def misses():
+        for i, source in enumerate(sources):
+            if isinstance(source, InvalidInput):
+                cached.append(batch_item(i, None, None, error=source.error))
+                continue
+            key, ace_input = prepare(source)
+            result = result_cache.get(key) if ace_input else None
+            if result is not None or not ace_input:
+                cached.append(batch_item(i, source, result))
+            else:
+                yield (i, source, key, ace_input)
+
+    def interact(proc, data):
+        return from_iterable(proc, (ace_input for _, _, _, ace_input in data))
+
+    if workers == 1:
+        responses = pool.interact_many(misses(), interact, timeout=wait,
+                                       budget=budget)
+    else:
+        responses = pool.interact_parallel(
+            misses(), interact, workers=workers, ordered=ordered,
+            timeout=wait, budget=budget
+        )
+    for (i, source, key, _), ace_response, seconds in responses:
+        while cached and (not ordered or cached[0]['index'] < i):
+            yield cached.popleft()
+        if ace_response is TIMED_OUT:
+            item = batch_item(i, source, None, seconds,
+                              error=timeout_message(budget))
+            item['timeout'] = budget
+            yield item
+        elif ace_response is None:
+            yield batch_item(i, source, None, seconds,
+                             error='ACE terminated on this input.')
+        else:
+            yield batch_item(i, source, finish(key, ace_response), seconds)
+    while cached:
+        yield cached.popleft()
+
+
+def batch_item(index, source, result, seconds=0.0, error=None):
+    item = {'index': index, 'input': source, 'result': result,
+            'time': seconds}
+    if error is not None:
+        item['error'] = error
+    return item
+
+
+def time_budget(grm, requested=None):
+    """
+    Return the seconds ACE may spend on each item for *grm*.
+
+    The budget is the grammar's `timeout`, or else the configured
+    `demophin.ace.timeout` (`None` for no limit). A client may ask for
+    a different budget (*requested*, e.g., from the header), but not
+    more than `demophin.ace.max_timeout`, which defaults to the
+    grammar's budget. Raises ValueError if *requested* is not a
+    positive number.
+    """
+    budget = grm.get('timeout', app.config.get('demophin.ace.timeout'))
+    if not requested:
+        return budget
+    requested = float(requested)
+    if not 0 < requested < float('inf'):  # also catches nan
+        raise ValueError(requested)
+    limit = app.config.get('demophin.ace.max_timeout', budget)
+    return requested if limit is None else min(requested, limit)
+
+
+def timed_out(result, budget):
+    # mark the partial ACE *result* (for parsing or generation) as
+    # stopped after *budget* seconds
+    if 'ERRORS' in result:
+        result['ERRORS'].append(timeout_message(budget))
+    else:
+        result['ERROR'] = timeout_message(budget)
+    result['TIMEOUT'] = budget
+    return result
+
+
+def timeout_message(budget):
+    return 'ACE took longer than %g seconds.' % budget
+
+
+def parse_options(grm, n):
+    # the number of results to return (see limit_nresults()) and the
+    # ACE options for parsing
+    n = limit_nresults(grm, n)
+    cmdargs = parser_cmdargs(grm, n=n)
+    # processes with the grammar's default -n can serve any smaller n
+    # (results are truncated in finish_parse()), so most requests share
+    # one pool
+    default_cmdargs = parser_cmdargs(grm)
+    if cmdargs_satisfy(default_cmdargs, cmdargs):
+        cmdargs = default_cmdargs
+    return n, cmdargs
+
+
+def limit_nresults(grm, n):
+    # n as an int limited to the grammar's or the configured
+    # max_results, so clients cannot have ACE produce (and keep) any
+    # number of results
+    if n is None:
+        return None
+    limit = grm.get('max_results',
+                    app.config.get('demophin.ace.max_results'))
+    n = max(1, int(n))
+    if limit is not None:
+        n = min(n, limit)
+    return n
+
+
+def queue_options(grm):
+    # the number of requests that may wait for a process of each of
+    # the grammar's pools, and the seconds each may wait (None for no
+    # limit); a grammar may override these with a "queue" object
+    queuecfg = {
+        'depth': app.config.get('demophin.ace.queue.depth'),
+        'max_wait': app.config.get('demophin.ace.queue.max_wait')
+    }
+    queuecfg.update(grm.get('queue', {}))
+    return queuecfg
+
+
+def overloaded(e):
+    # the 503 response for a request that could not get a process
+    logging.warning('Refusing request: %s', e)
+    return HTTPError(503, 'The server is busy. Please try again later.',
+                     **{'Retry-After': str(retry_after())})
+
+
+def retry_after():
+    # seconds a refused client should wait before trying again
+    return app.config.get('demophin.ace.queue.retry_after', 5)
+
+
+def shed_load(items):
+    # as overloaded(), for batches; once output has started, a busy
+    # pool can only end it
+    try:
+        for item in items:
+            yield item
+    except AcePoolBusy as e:
+        raise overloaded(e)
+
+
+def parse_key(grm, sent, n, cmdargs, version):
+    return ('parse', grm['name'].lower(), version, sent, n, tuple(cmdargs))
+
+
+def finish_parse(key, result, n, complete):
     if not result:
         return None
-    result['RESULTS'] = [d3ify_dmrs(res['MRS'])
-                         for res in result['RESULTS']]
+    layout = app.config.get('demophin.layout', True)
+    result['RESULTS'] = [d3ify_dmrs(res['MRS'], layout=layout)
+                         for res in result['RESULTS'][:n]]
+    if complete:
+        result_cache.set(key, result)
     return result
 
 
-def d3ify_dmrs(x):
+def grammar_version(grm):
+    # changes when the grammar image is replaced, invalidating results
+    # and the processes that have the old image loaded; a request
+    # takes it once, so its cache keys and its processes agree
+    st = os.stat(grm['path'])
+    return (st.st_mtime, st.st_size)
+
+
+def cmdargs_satisfy(available, requested):
+    # True if ACE run with *available* gives every result it would
+    # give with *requested*
+    def others(args):
+        return [arg for arg in args if not arg.startswith('-n ')]
+    if others(available) != others(requested):
+        return False
+    avail_n, req_n = max_results(available), max_results(requested)
+    return avail_n is None or (req_n is not None and req_n <= avail_n)
+
+
+def ace_pool(cls, grm, cmdargs, keep_open=False, version=None):
+    # only the default pools opened by start_pools() keep processes
+    # open while unused; others are created on demand. The pool is for
+    # the *version* of the grammar image (by default, the current one).
+    if version is None:
+        version = grammar_version(grm)
+    poolcfg = {
+        'min': app.config.get('demophin.ace.pool.min', 1),
+        'max': app.config.get('demophin.ace.pool.max', 4)
+    }
+    poolcfg.update(grm.get('pool', {}))
+    return ace_registry.pool(
+        cls, grm['path'], cmdargs,
+        minsize=poolcfg['min'] if keep_open else 0,
+        maxsize=poolcfg['max'],
+        maxqueue=queue_options(grm)['depth'], version=version,
+        executable=ace_options['executable'], env=ace_options['env']
+    )
+
+
+def d3ify_dmrs(x, layout=False):
+    # straight from the SimpleMRS string to what the client displays
+    xnodes, xlinks = fast_nodes_and_links(x)
     data = {'nodes': [], 'links': [], 'mrs': x}
-    x = loads_one(x)
     nodeidx = {0: 0}
-    for i, node in enumerate(nodes(x)):
+    for i, node in enumerate(xnodes):
         cfrom, cto = node[3][1] if node[3] is not None else (-1, -1)
-        cvarsort = node[2].get('cvarsort') if node[2] is not None else None
-        varprops = x.properties(node[0])
+        varprops = node[2] if node[2] is not None else {}  # a new dict
+        cvarsort = varprops.pop('cvarsort', None)
         carg = node[6] if len(node) >= 7 else None
 
         data['nodes'].append({
@@ -150,7 +595,7 @@ def d3ify_dmrs(x):
             'varprops': varprops
         })
         nodeidx[node[0]] = i+1
-    for link in links(x):
+    for link in xlinks:
         data['links'].append({
             'source': nodeidx[link[0]],
             'target': nodeidx[link[1]],
@@ -159,21 +604,199 @@ def d3ify_dmrs(x):
             'rargname': link[2] or "",
             'post': link[3]
         })
+    if layout:
+        layout_dmrs(data)
     return data
 
 
+def layout_dmrs(data):
+    """
+    Lay out the links of the d3ify_dmrs() *data* for display.
+
+    This does what prepareGraph() in static/dmrs.js would do on the
+    client, which skips it for data laid out here: links get the
+    (0-based) `source` and `target` positions of their nodes, a
+    direction (`dir`; 1 above the nodes, -1 below), the `distance`
+    between their nodes, and the `level` they are drawn at, and the
+    data gets the outermost levels used (`maxTopLevel` and
+    `maxBottomLevel`). Shorter links are placed first, each at the
+    level nearest the nodes where no link already spans any of the
+    same gaps between nodes; those gaps are kept as a bitmask per
+    level, so finding a level takes one test per level.
+    """
+    nodeidx = dict((node['id'], i) for i, node in enumerate(data['nodes']))
+    arcs = []
+    for link in data['links']:
+        link['target'] = nodeidx[link['end']]
+        if link['start'] == 0:  # TOP link
+            link['dir'] = 1  # always on top
+            continue
+        link['source'] = nodeidx[link['start']]
+        link['distance'] = abs(link['source'] - link['target'])
+        # quantifiers and undirected EQ links below preds
+        below = link['rargname'] == '' or link['post'].upper() == 'H'
+        link['dir'] = -1 if below else 1
+        arcs.append(link)
+    levels = {1: [], -1: []}  # dir: gaps spanned at each level
+    for link in sorted(arcs, key=lambda link: link['distance']):
+        lo = min(link['source'], link['target'])
+        gaps = ((1 << link['distance']) - 1) << lo
+        used = levels[link['dir']]
+        for i, spanned in enumerate(used):
+            if not spanned & gaps:
+                used[i] |= gaps
+                break
+        else:
+            i = len(used)
+            used.append(gaps)
+        link['level'] = (i + 1) * link['dir']
+    data['maxTopLevel'] = len(levels[1])
+    data['maxBottomLevel'] = -len(levels[-1])
+
+
+def wants_mrs(params):
+    # clients that do not generate from results can do without the
+    # SimpleMRS strings, e.g., with mrs=0
+    return params.get('mrs', '1').lower() not in ('0', 'false', 'no')
+
+
+def without_mrs(result):
+    # a copy of the (possibly cached) parse *result* without the
+    # SimpleMRS strings
+    if not result:
+        return result
+    result = dict(result)
+    result['RESULTS'] = [dict((k, v) for k, v in res.items() if k != 'mrs')
+                         for res in result['RESULTS']]
+    return result
+
+
 @route('/<grmkey>/generate', method='POST')
 def generate(grmkey):
     grm = get_grammar(grmkey)
     mrs = request.forms.get('mrs')
-    return generate_sentences(grm, mrs)
+    try:
+        return generate_sentences(grm, mrs, budget=read_budget(grm))
+    except AcePoolBusy as e:
+        raise overloaded(e)
+
+
+@route('/<grmkey>/generate/batch', method='POST')
+def generate_batch(grmkey):
+    grm = get_grammar(grmkey)
+    budget = read_budget(grm)
+    mrss = read_batch()
+    return ndjson(shed_load(generate_from_mrss(grm, mrss, budget=budget)))
 
 
-def generate_sentences(grm, mrs):
+def generate_sentences(grm, mrs, budget=None):
     if not mrs:
         return None
-    with AceGenerator(grm['path'], **ace_options) as generator:
-        return generator.interact(mrs)
+    cmdargs = normalize_cmdargs(ace_options['cmdargs'])
+    version = grammar_version(grm)
+    key = generate_key(grm, mrs, cmdargs, version)
+    result = result_cache.get(key)
+    if result is not None:
+        return result
+
+    def run():
+        pool = ace_pool(AceGenerator, grm, cmdargs, version=version)
+        wait = queue_options(grm)['max_wait']
+        with pool.process(timeout=wait) as generator, \
+                Watchdog(generator, budget) as watchdog:
+            result = generator.interact(mrs)
+            complete = generator.is_alive()  # partial if ACE died
+        if watchdog.expired:
+            result = timed_out(result, budget)
+        return finish_generate(key, result, complete)
+
+    # as in parse_sentence()
+    return in_flight.do(key + (budget,), run)
+
+
+def generate_from_mrss(grm, mrss, budget=None):
+    """
+    Yield a dict with the result for each MRS in *mrss*, in order.
+
+    MRSs not in the cache are streamed through one ACE process, and
+    any that take longer than *budget* seconds get an error.
+    """
+    cmdargs = normalize_cmdargs(ace_options['cmdargs'])
+    version = grammar_version(grm)
+    return run_batch(
+        ace_pool(AceGenerator, grm, cmdargs, version=version),
+        interact_from_iterable, mrss,
+        lambda mrs: (generate_key(grm, mrs, cmdargs, version), mrs),
+        lambda key, result: finish_generate(key, result, True),
+        budget=budget, wait=queue_options(grm)['max_wait']
+    )
+
+
+def generate_key(grm, mrs, cmdargs, version):
+    return ('generate', grm['name'].lower(), version, canonical_mrs(mrs),
+            tuple(cmdargs))
+
+
+def finish_generate(key, result, complete):
+    if complete:
+        result_cache.set(key, result)
+    return result
+
+
+def canonical_mrs(mrs):
+    # MRSs differing only in variable names or EP order generate the
+    # same sentences, so they share a canonical form
+    try:
+        return fast_dumps_one(canonicalize(fast_loads_one(mrs)))
+    except Exception as e:
+        logging.debug("Cannot canonicalize MRS (Error = %s)" % (e,))
+        return mrs.strip()
+
+
+def start_pools():
+    """
+    Open the configured minimum number of ACE processes per grammar.
+
+    Pool sizes are set at `demophin.ace.pool` and may be overridden
+    with a `pool` object on individual grammars, e.g.:
+    `"pool": {"min": 1, "max": 4}`. The total number of ACE processes
+    is limited by `demophin.ace.pool.max_processes`.
+    """
+    close_pools()
+    pools = []
+    for grm in grammars.values():
+        if not os.path.isfile(grm.get('path', '')):
+            logging.warning('Grammar not found for %s: %s'
+                            % (grm['name'], grm.get('path')))
+            continue
+        pools.append(ace_pool(AceParser, grm, parser_cmdargs(grm), True))
+        pools.append(
+            ace_pool(AceGenerator, grm, ace_options['cmdargs'], True)
+        )
+    for pool in pools:
+        try:
+            pool.start()
+        except (OSError, ValueError, AcePoolError) as e:
+            logging.error("Could not start ACE (Error = %s)" % (e,))
+
+
+def close_pools():
+    ace_registry.close()
+
+
+def load_preprocessors():
+    """
+    Load, set up, and warm the preprocessor of each grammar.
+
+    Grammars whose image is missing are skipped, as by start_pools().
+    PreprocessorError is raised if any other preprocessor fails, so
+    that it stops the server before any request is made.
+    """
+    for grm in grammars.values():
+        if grm.get('preprocessor') and os.path.isfile(grm.get('path', '')):
+            preprocessors.load(grm['preprocessor'])
+
+atexit.register(close_pools)
 
 @error(404)
 @view('error404')
@@ -181,20 +804,134 @@ def error404(error):
     return {'error': error.body}
 
 
-if __name__ == '__main__':
-    if len(sys.argv) > 1 and not sys.argv[1].startswith('-'):
+class ThreadPoolWSGIServer(WSGIServer):
+    # requests are handled by a fixed number of threads (set by
+    # server_options()), so the pools can be sized to match; further
+    # connections wait in a queue until a thread is free
+    threads = 4
+
+    def server_activate(self):
+        WSGIServer.server_activate(self)
+        self._requests = queue.Queue()
+        for _ in range(self.threads):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def _work(self):
+        while True:
+            request, client_address = self._requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+class GunicornServer(ServerAdapter):
+    # Bottle's own gunicorn adapter reads gunicorn's command-line
+    # options from sys.argv, which holds demophin's options here
+    def run(self, handler):
+        from gunicorn.app.base import BaseApplication
+        options = dict(self.options, bind='%s:%d' % (self.host, self.port))
+
+        class Application(BaseApplication):
+            def load_config(self):
+                for key, value in options.items():
+                    self.cfg.set(key, value)
+
+            def load(self):
+                return handler
+
+        Application().run()
+
+
+def configure_server(threads):
+    """
+    Size the ACE pools for a server with *threads* request threads.
+
+    Each thread may need its own process for the default options of a
+    grammar, so pools are allowed to grow to *threads* processes (and
+    the limit across all pools to at least that many).
+    """
+    app.config['demophin.ace.pool.max'] = threads
+    ace_registry.maxprocs = max(ace_registry.maxprocs, threads)
+
+
+def server_options(server, workers, threads):
+    # the Bottle server adapter and its options for *server* with
+    # *workers* processes of *threads* threads each
+    if server == 'threaded':
+        class Server(ThreadPoolWSGIServer):
+            pass
+        Server.threads = threads
+        return 'wsgiref', {'server_class': Server}
+    elif server == 'cherrypy':
+        return 'cherrypy', {'numthreads': threads}
+    elif server == 'paste':
+        return 'paste', {'use_threadpool': True,
+                         'threadpool_workers': threads}
+    elif server == 'gunicorn':
+        # processes with open pipes cannot be shared across a fork, so
+        # each worker opens its own after forking
+        return GunicornServer, {
+            'workers': workers,
+            'threads': threads,
+            'worker_class': 'gthread',
+            'post_fork': lambda server, worker: start_pools()
+        }
+    return server, {}
+
+
+def cli(args=None):
+    parser = argparse.ArgumentParser(description='Serve Demophin.')
+    parser.add_argument('grammar', nargs='?',
+                        help='serve only this grammar image')
+    parser.add_argument('--server', default='threaded',
+                        choices=('wsgiref', 'threaded', 'cherrypy', 'paste',
+                                 'gunicorn'),
+                        help='WSGI server (default: threaded)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='server processes (gunicorn only; default: 1)')
+    parser.add_argument('--threads', type=int,
+                        help='request threads per process (default: '
+                             'demophin.ace.pool.max)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('-v', action='store_true', help='debug logging')
+    args = parser.parse_args(args)
+    if args.workers < 1 or (args.threads is not None and args.threads < 1):
+        parser.error('--workers and --threads must be at least 1')
+    if args.workers > 1 and args.server != 'gunicorn':
+        parser.error('--workers requires --server gunicorn')
+    if args.v:
+        logging.basicConfig(level=logging.DEBUG)
+        logging.debug("Debug mode is activated")
+    if args.grammar:
         app.config['demophin.grammars'] = [{
-            "name": os.path.basename(sys.argv[1]),
-            "path": sys.argv[1]
+            "name": os.path.basename(args.grammar),
+            "path": args.grammar
         }]
-        #TODO: use argparse instead
-    for arg in sys.argv:
-        if arg == '-v':
-            logging.basicConfig(level=logging.DEBUG)
-            logging.debug("Debug mode is activated")
-                
-        grammars = {}
+        grammars.clear()
         for gramdata in app.config['demophin.grammars']:
             grammars[gramdata['name'].lower()] = gramdata
 
-    run()
+    threads = args.threads
+    if args.server == 'wsgiref':
+        threads = 1
+    elif threads is None:
+        threads = app.config.get('demophin.ace.pool.max', 4)
+    configure_server(threads)
+    load_preprocessors()
+    server, options = server_options(args.server, args.workers, threads)
+    if args.server != 'gunicorn':
+        start_pools()
+    run(server=server, host=args.host, port=args.port, **options)
+
+
+if __name__ == '__main__':
+    cli()
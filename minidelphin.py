@@ -12,11 +12,27 @@ from __future__ import print_function
 
 import os
 import re
+import sys
+import mmap
+import codecs
+import hashlib
 import logging
+import threading
+from array import array
 from collections import (OrderedDict, deque, defaultdict, namedtuple)
 from itertools import chain
 from subprocess import (check_call, CalledProcessError, Popen, PIPE, STDOUT)
 
+try:
+    from sys import intern
+except ImportError:  # Python 2
+    pass
+
+try:
+    _int_types = (int, long)
+except NameError:  # Python 3
+    _int_types = (int,)
+
 IVARG_ROLE = 'ARG0'
 CONSTARG_ROLE = 'CARG'
 QUANTIFIER_POS = 'q'
@@ -35,6 +51,9 @@ class XmrsDeserializationError(XmrsError):
     pass
 
 
+XDE = XmrsDeserializationError
+
+
 class Xmrs(object):
     def __init__(self, top=None, index=None, xarg=None,
                  eps=None, hcons=None, icons=None, vars=None,
@@ -415,6 +434,235 @@ class Xmrs(object):
         )
 
 
+class CompactXmrs(object):
+    """
+    A memory-compact, read-only variant of Xmrs.
+
+    Arguments are as for Xmrs, or use from_xmrs() to compact an
+    existing Xmrs. EPs are stored column-wise in tuples, arguments and
+    properties as flat tuples of interned strings, and the variable
+    references that Xmrs indexes up front are computed when needed.
+    The accessors are the same as those of Xmrs, and to_xmrs() gives
+    a full Xmrs for anything else. On the synthetic corpus of
+    benchmarks/bench_memory.py, it takes about a sixth of the memory.
+    """
+
+    __slots__ = ('top', 'index', 'xarg', 'lnk', 'surface', 'identifier',
+                 '_nodeids', '_preds', '_labels', '_args', '_lnks',
+                 '_surfaces', '_bases', '_vars', '_props', '_hcons',
+                 '_icons')
+
+    def __init__(self, top=None, index=None, xarg=None,
+                 eps=None, hcons=None, icons=None, vars=None,
+                 lnk=None, surface=None, identifier=None):
+        self._load(Xmrs(top=top, index=index, xarg=xarg, eps=eps,
+                        hcons=hcons, icons=icons, vars=vars, lnk=lnk,
+                        surface=surface, identifier=identifier))
+
+    @classmethod
+    def from_xmrs(cls, xmrs):
+        m = cls.__new__(cls)
+        m._load(xmrs)
+        return m
+
+    def _load(self, x):
+        self.top = _intern_opt(x.top)
+        self.index = _intern_opt(x.index)
+        self.xarg = _intern_opt(x.xarg)
+        self.lnk = x.lnk
+        self.surface = x.surface
+        self.identifier = x.identifier
+        eps = x.eps()
+        self._nodeids = tuple(ep[0] for ep in eps)
+        self._preds = tuple(ep[1] for ep in eps)
+        self._labels = tuple(_intern_opt(ep[2]) for ep in eps)
+        self._args = tuple(_flatten(ep[3].items()) for ep in eps)
+        # (lnk, surface, base) columns are omitted if no EP has them
+        self._lnks = _optional_column(eps, 4)
+        self._surfaces = _optional_column(eps, 5)
+        self._bases = _optional_column(eps, 6)
+        self._vars = tuple(intern(v) for v in x._vars)
+        self._props = dict((intern(v), _flatten(vd['props']))
+                           for v, vd in x._vars.items() if vd['props'])
+        self._hcons = tuple(tuple(_intern_opt(a) for a in hc)
+                            for hc in x.hcons())
+        self._icons = tuple(tuple(_intern_opt(a) for a in ic)
+                            for ic in x.icons())
+
+    def to_xmrs(self):
+        return Xmrs(
+            top=self.top, index=self.index, xarg=self.xarg,
+            eps=self.eps(), hcons=self.hcons(), icons=self.icons(),
+            vars=dict((v, self._var_props(v)) for v in self._vars),
+            lnk=self.lnk, surface=self.surface, identifier=self.identifier
+        )
+
+    def __repr__(self):
+        if self.surface is not None:
+            stringform = '"{}"'.format(self.surface)
+        else:
+            stringform = ' '.join(pred.lemma for pred in self._preds)
+        return '<CompactXmrs object ({}) at {}>'.format(stringform, id(self))
+
+    def __contains__(self, obj):
+        return obj in self._nodeids or obj in self._vars
+
+    def __eq__(self, other):
+        if not isinstance(other, (Xmrs, CompactXmrs)):
+            return NotImplemented
+        if ((self.top, self.index, self.xarg) !=
+                (other.top, other.index, other.xarg)):
+            return False
+        return (sorted(self.eps()) == sorted(other.eps()) and
+                sorted(self.hcons()) == sorted(other.hcons()) and
+                sorted(self.icons()) == sorted(other.icons()))
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    ltop = Xmrs.ltop
+    cfrom = Xmrs.cfrom
+    cto = Xmrs.cto
+
+    # basic access to internal structures
+
+    def ep(self, nodeid):
+        return self._ep(self._nodeids.index(nodeid))
+
+    def eps(self, nodeids=None):
+        if nodeids is None:
+            return [self._ep(i) for i in range(len(self._nodeids))]
+        return [self.ep(nodeid) for nodeid in nodeids]
+
+    def hcon(self, hi):
+        for hc in self._hcons:
+            if hc[0] == hi:
+                return hc
+        raise KeyError(hi)
+
+    def hcons(self): return list(self._hcons)
+
+    def icons(self, left=None):
+        if left is not None:
+            ics = [ic for ic in self._icons if ic[0] == left]
+            if not ics:
+                raise KeyError(left)
+            return ics
+        return list(self._icons)
+
+    def variables(self): return list(self._vars)
+
+    # access to internal sub-structures
+
+    def properties(self, var_or_nodeid):
+        if var_or_nodeid in self._vars:
+            return dict(self._var_props(var_or_nodeid))
+        elif var_or_nodeid in self._nodeids:
+            var = self.args(var_or_nodeid).get(IVARG_ROLE)
+            return dict(self._var_props(var))
+        else:
+            raise KeyError(var_or_nodeid)
+
+    def pred(self, nodeid):
+        return self._preds[self._nodeids.index(nodeid)]
+
+    def preds(self, nodeids=None):
+        if nodeids is None:
+            return list(self._preds)
+        return [self.pred(nid) for nid in nodeids]
+
+    def label(self, nodeid):
+        return self._labels[self._nodeids.index(nodeid)]
+
+    def labels(self, nodeids=None):
+        if nodeids is None:
+            return list(self._labels)
+        return [self.label(nid) for nid in nodeids]
+
+    def args(self, nodeid):
+        return _unflatten(self._args[self._nodeids.index(nodeid)])
+
+    # calculated sub-structures
+
+    def labelset(self, label):
+        return [nid for nid, lbl in zip(self._nodeids, self._labels)
+                if lbl == label]
+
+    def labelset_heads(self, label):
+        # as Xmrs.labelset_heads(), but finding references by scanning
+        # the arguments of the EPs in the labelset
+        nodeids = {}
+        argvals = {}
+        preds = {}
+        for nid, pred, lbl, args in zip(self._nodeids, self._preds,
+                                        self._labels, self._args):
+            if lbl == label:
+                vals = args[1::2]
+                argvals[nid] = vals
+                preds[nid] = pred
+                nodeids[nid] = dict(zip(args[::2], vals)).get(IVARG_ROLE)
+        if len(nodeids) <= 1:
+            return list(nodeids)
+
+        ivs = {iv: nodeid for nodeid, iv in nodeids.items() if iv is not None}
+        out = {n: len(list(filter(ivs.__contains__, argvals[n])))
+               for n in nodeids}
+        candidates = [n for n, out_deg in out.items() if out_deg <= 1]
+        in_ = {}
+        q = {}
+        for n in candidates:
+            iv = nodeids[n]
+            # every EP in the labelset refers to the label once
+            in_[n] = sum(vals.count(iv) + (iv == label)
+                         for vals in argvals.values())
+            q[n] = 1 if preds[n].is_quantifier() else 0
+
+        return sorted(candidates, key=lambda n: (out[n], -in_[n], -q[n], n))
+
+    def subgraph(self, nodeids):
+        return CompactXmrs.from_xmrs(self.to_xmrs().subgraph(nodeids))
+
+    def is_connected(self):
+        return self.to_xmrs().is_connected()
+
+    def is_well_formed(self):
+        return self.to_xmrs().is_well_formed()
+
+    def _ep(self, i):
+        ep = (self._nodeids[i], self._preds[i], self._labels[i],
+              _unflatten(self._args[i]))
+        for column in (self._lnks, self._surfaces, self._bases):
+            if column is None:
+                break
+            ep += (column[i],)
+        return ep
+
+    def _var_props(self, var):
+        props = self._props.get(var, ())
+        return list(zip(props[::2], props[1::2]))
+
+
+def _intern_opt(s):
+    # intern strings, but leave None and other values alone
+    return intern(s) if isinstance(s, str) else s
+
+
+def _flatten(pairs):
+    return tuple(_intern_opt(x) for pair in pairs for x in pair)
+
+
+def _unflatten(flat):
+    return dict(zip(flat[::2], flat[1::2]))
+
+
+def _optional_column(eps, i):
+    # the i-th items of *eps*, or None if no EP is that long
+    if all(len(ep) <= i for ep in eps):
+        return None
+    return tuple(ep[i] if len(ep) > i else None for ep in eps)
+
+
 class Pred(namedtuple('Pred', ('type', 'lemma', 'pos', 'sense', 'string'))):
     pred_re = re.compile(
         r'_?(?P<lemma>.*?)_'  # match until last 1 or 2 parts
@@ -429,6 +677,8 @@ class Pred(namedtuple('Pred', ('type', 'lemma', 'pos', 'sense', 'string'))):
     STRINGPRED = 2  # quoted string form of realpred
 
     def __eq__(self, other):
+        if other is self:
+            return True  # usual for Preds from pred_cache
         if other is None:
             return False
         if isinstance(other, Pred):
@@ -456,6 +706,10 @@ class Pred(namedtuple('Pred', ('type', 'lemma', 'pos', 'sense', 'string'))):
 
     @staticmethod
     def string_or_grammar_pred(predstr):
+        return pred_cache.get(predstr)
+
+    @staticmethod
+    def _string_or_grammar_pred(predstr):
         if predstr.strip('"').lstrip("'").startswith('_'):
             return Pred.stringpred(predstr)
         else:
@@ -477,6 +731,65 @@ class Pred(namedtuple('Pred', ('type', 'lemma', 'pos', 'sense', 'string'))):
         return self.pos == QUANTIFIER_POS
 
 
+class PredCache(object):
+    """
+    A bounded cache of Preds by their string forms.
+
+    A grammar's predicates are a few thousand strings that recur in
+    every MRS, so each is parsed once and the same (immutable) Pred is
+    shared by every EP that uses it. When *maxsize* strings are cached,
+    the earliest cached is dropped to make room for another.
+
+    Args:
+        maxsize: the maximum number of Preds to keep
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # predstr: Pred; oldest first
+        self._lock = threading.Lock()
+        # counters are not locked, so under threads they are estimates
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, predstr):
+        pred = self._data.get(predstr)
+        if pred is not None:
+            self.hits += 1
+            return pred
+        self.misses += 1
+        pred = Pred._string_or_grammar_pred(predstr)
+        with self._lock:
+            # another thread may have cached it in the meantime
+            pred = self._data.setdefault(predstr, pred)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+        return pred
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            'evictions': self.evictions
+        }
+
+
+pred_cache = PredCache()
+
+
 def split_pred_string(predstr):
     match = Pred.pred_re.search(predstr)
     if match is None:
@@ -487,6 +800,8 @@ def split_pred_string(predstr):
 
 
 def links(xmrs):
+    if isinstance(xmrs, CompactXmrs):
+        xmrs = xmrs.to_xmrs()
     links = []
     prelinks = []
 
@@ -569,6 +884,295 @@ def nodes(xmrs):
     return nodes
 
 
+def nodes_and_links(xmrs):
+    """
+    Return the same lists as `(nodes(xmrs), links(xmrs))`.
+
+    All the indexes needed (intrinsic variables to nodeids, labels to
+    EPs, holes to the labels they are qeq to) are built in one pass
+    over the EPs, rather than computing labelset heads from the
+    variable references label by label. *xmrs* may be an Xmrs or a
+    CompactXmrs.
+    """
+    # reassign these locally to avoid global lookup
+    IV = IVARG_ROLE
+    CARG = CONSTARG_ROLE
+    _digits = '0123456789'
+    _props = xmrs.properties
+    variables = set(xmrs.variables())
+    nodes = []
+    ivtargets = {}  # iv: (nodeid, label) of first non-quantifier EP
+    labelsets = {}  # label: [(nodeid, pred, args), ...]
+    prelinks = []
+    top = xmrs.top
+    if top is not None:
+        prelinks.append((0, top, None, top))
+    for ep in xmrs.eps():
+        nid, pred, lbl, args = ep[0], ep[1], ep[2], ep[3]
+        sortinfo = None
+        iv = args.get(IV)
+        if iv is not None:
+            sortinfo = _props(iv)
+            # the sort is all but the trailing digits of the variable
+            sortinfo['cvarsort'] = iv.rstrip(_digits)
+            if (iv not in ivtargets and iv in variables and
+                    not pred.is_quantifier()):
+                ivtargets[iv] = (nid, lbl)
+        if len(ep) == 6:  # as from the SimpleMRS readers
+            nodes.append((nid, pred, sortinfo, ep[4], ep[5], None,
+                          args.get(CARG)))
+        else:
+            nodes.append((nid, pred, sortinfo) +
+                         (tuple(ep[4:7]) + (None, None, None))[:3] +
+                         (args.get(CARG),))
+        if lbl is not None:
+            if lbl in labelsets:
+                labelsets[lbl].append((nid, pred, args))
+            else:
+                labelsets[lbl] = [(nid, pred, args)]
+        for role, val in args.items():
+            if role != IV and val in variables:
+                prelinks.append((nid, lbl, role, val))
+    heads = dict((lbl, _labelset_heads(lbl, members, variables))
+                 for lbl, members in labelsets.items())
+    hcons = dict((hc[0], hc[2]) for hc in xmrs.hcons())
+
+    links = []
+    for src, srclbl, role, val in prelinks:
+        if val in ivtargets:
+            tgt, tgtlbl = ivtargets[val]  # what do we do if len > 1?
+            post = 'EQ' if srclbl == tgtlbl else 'NEQ'
+        elif val in hcons:
+            lbl = hcons[val]
+            if not heads.get(lbl):
+                continue  # broken MRS; log this?
+            tgt, post = heads[lbl][0], 'H'
+        elif val in heads:
+            if not heads[val]:
+                continue  # broken MRS; log this?
+            tgt, post = heads[val][0], 'HEQ'
+        else:
+            continue  # CARGs, maybe?
+        links.append((src, tgt, role, post))
+    # now EQ links unattested by arg links
+    for lblheads in heads.values():
+        for other in lblheads[1:]:
+            links.append((lblheads[0], other, None, 'EQ'))
+    links.sort()
+    return nodes, links
+
+
+def _labelset_heads(label, members, variables):
+    # as Xmrs.labelset_heads(), for the (nodeid, pred, args) *members*
+    # of the labelset of *label*
+    if len(members) <= 1:
+        return [nid for nid, _, _ in members]
+    ivs = set()
+    counts = defaultdict(int)  # references from within the labelset
+    for _, _, args in members:
+        iv = args.get(IVARG_ROLE)
+        if iv is not None:
+            ivs.add(iv)
+        for val in args.values():
+            if val in variables:
+                counts[val] += 1
+    counts[label] += len(members)
+    keys = []
+    for nid, pred, args in members:
+        out = sum(1 for val in args.values() if val in ivs)
+        # out_deg is 1 for ARG0, but <= 1 because sometimes ARG0 is missing
+        if out <= 1:
+            iv = args.get(IVARG_ROLE)
+            in_ = counts[iv] if iv in variables else 0
+            keys.append((out, -in_, -int(pred.is_quantifier()), nid))
+    return [key[-1] for key in sorted(keys)]
+
+
+def canonicalize(xmrs):
+    """
+    Return a copy of *xmrs* with its EPs and variables in a canonical order.
+
+    EPs are ordered by their surface alignment, predicate, roles, and
+    constant argument, with ties (e.g., two lnk-less udef_q EPs)
+    broken by the colours fingerprint() gives their label and argument
+    variables; variables are then renumbered (and EPs given new
+    nodeids) in the order they are encountered. Two Xmrs objects that
+    differ only in variable names or EP order therefore have the same
+    canonical form, and serialize the same way, unless they have EPs
+    that the colours cannot tell apart but that are not symmetric,
+    which is rare.
+    """
+    _vars = xmrs._vars
+    colours = _colour_variables(xmrs)[0]
+    names = {}
+
+    def rename(var):
+        if var not in names:
+            names[var] = '{}{}'.format(var_re.match(var).group(1), len(names))
+        return names[var]
+
+    def is_var(val):
+        return val in _vars or var_re.match(val) is not None
+
+    def ep_sortkey(ep):
+        lnk = ep[4] if len(ep) >= 5 and ep[4] is not None else (0, (-1, -1))
+        args = ep[3]
+        roles = sorted(args, key=rargname_sortkey)
+        vals = [ep[2]] + [args[role] for role in roles]
+        return (lnk[1], ep[1].string, roles, args.get(CONSTARG_ROLE, ''),
+                [colours.get(val, '') for val in vals])
+
+    if xmrs.top is not None: rename(xmrs.top)
+    if xmrs.index is not None: rename(xmrs.index)
+    if xmrs.xarg is not None: rename(xmrs.xarg)
+    eps = []
+    for i, ep in enumerate(sorted(xmrs.eps(), key=ep_sortkey)):
+        lbl = None if ep[2] is None else rename(ep[2])
+        args = {}
+        for role in sorted(ep[3], key=rargname_sortkey):
+            val = ep[3][role]
+            if role.upper() != CONSTARG_ROLE and is_var(val):
+                val = rename(val)
+            args[role] = val
+        eps.append((10000 + i, ep[1], lbl, args) + tuple(ep[4:]))
+    # by now nearly all variables are named; name the rest (e.g., the
+    # unbound lo handles of qeqs) in an order not given by the input,
+    # then order constraints by the names
+    def var_key(var):
+        if var in names:
+            return (0, int(var_re.match(names[var]).group(2)), '')
+        return (1, 0, colours.get(var, ''))
+
+    def cons_prekey(c):
+        return (var_key(c[0]), c[1], var_key(c[2]))
+
+    def cons_sortkey(c):
+        return (int(var_re.match(c[0]).group(2)), c[1],
+                int(var_re.match(c[2]).group(2)))
+    hcons = sorted([(rename(hi), reln, rename(lo))
+                    for hi, reln, lo in sorted(xmrs.hcons(), key=cons_prekey)],
+                   key=cons_sortkey)
+    icons = sorted([(rename(left), reln, rename(right))
+                    for left, reln, right in sorted(xmrs.icons(),
+                                                    key=cons_prekey)],
+                   key=cons_sortkey)
+    vars_ = dict((names[var], list(vd['props']))
+                 for var, vd in _vars.items() if var in names)
+    return Xmrs(
+        top=names.get(xmrs.top), index=names.get(xmrs.index),
+        xarg=names.get(xmrs.xarg), eps=eps, hcons=hcons, icons=icons,
+        vars=vars_, lnk=xmrs.lnk, surface=xmrs.surface,
+        identifier=xmrs.identifier
+    )
+
+
+def fingerprint(xmrs, lnk=True):
+    """
+    Return a hash of the structure of *xmrs* as a hex string.
+
+    Variable names, nodeids, and the order of EPs and constraints do
+    not affect the fingerprint, so Xmrs objects that differ only in
+    those ways (e.g., the same analysis from different parses) have
+    the same fingerprint. Each variable is described by its sort, its
+    properties, and how the EPs and constraints use it, so distinct
+    structures nearly always get distinct fingerprints. If *lnk* is
+    `False`, surface alignments are ignored as well. *xmrs* may be an
+    Xmrs or a CompactXmrs.
+    """
+    colours, eps = _colour_variables(xmrs, lnk)
+    toks = ['%s:%s' % (role, colours.get(var, var))
+            for role, var in (('TOP', xmrs.top), ('INDEX', xmrs.index),
+                              ('XARG', xmrs.xarg))]
+    final = []
+    for desc, lbl, args, roles in eps:
+        final.append(' '.join(
+            [desc, colours.get(lbl, '')] +
+            [colours.get(args[role], '') for role in roles]
+        ))
+    toks.extend(sorted(final))
+    toks.extend(sorted('%s %s %s' % (colours.get(hc[0]), hc[1],
+                                     colours.get(hc[2]))
+                       for hc in xmrs.hcons()))
+    toks.extend(sorted('%s %s %s' % (colours.get(ic[0]), ic[1],
+                                     colours.get(ic[2]))
+                       for ic in xmrs.icons()))
+    return _digest('\n'.join(toks), 40)
+
+
+def _colour_variables(xmrs, lnk=True):
+    # return a {var: colour} map describing each variable of *xmrs* by
+    # its sort, properties, and uses, and the (desc, lbl, args, roles)
+    # description of each EP; the colours do not depend on variable
+    # names or the order of EPs
+    _digits = '0123456789'
+    _props = xmrs.properties
+    # first describe variables by their sort and properties
+    colours = {}
+    for var in xmrs.variables():
+        props = ' '.join(sorted('%s=%s' % kv for kv in _props(var).items()))
+        colours[var] = '%s[%s]' % (var.rstrip(_digits), props)
+    # then EPs by their predicates, constants, and argument variables
+    eps = []
+    for ep in xmrs.eps():
+        args = ep[3]
+        toks = [ep[1].string.strip('"\'')]  # as Pred.__eq__()
+        if lnk:
+            toks.append(repr(ep[4]) if len(ep) >= 5 else 'None')
+            toks.append(repr(ep[5]) if len(ep) >= 6 else 'None')
+        roles = sorted(args)
+        if ep[2] is not None:
+            toks.append('LBL:' + colours.get(ep[2], ep[2]))
+        for role in roles:
+            val = args[role]
+            toks.append('%s:%s' % (role, colours.get(val, '"%s"' % val)))
+        eps.append((' '.join(toks), ep[2], args, roles))
+    # then variables again by how they are used, and EPs by those
+    uses = defaultdict(list)
+    for desc, lbl, args, roles in eps:
+        if lbl is not None:
+            uses[lbl].append('LBL<' + desc)
+        for role in roles:
+            uses[args[role]].append(role + '<' + desc)
+    for hi, reln, lo in (hc[:3] for hc in xmrs.hcons()):
+        uses[hi].append('%s>%s' % (reln, colours.get(lo, lo)))
+        uses[lo].append('%s<%s' % (reln, colours.get(hi, hi)))
+    for left, reln, right in (ic[:3] for ic in xmrs.icons()):
+        uses[left].append('%s>%s' % (reln, colours.get(right, right)))
+        uses[right].append('%s<%s' % (reln, colours.get(left, left)))
+    for role, var in (('TOP', xmrs.top), ('INDEX', xmrs.index),
+                      ('XARG', xmrs.xarg)):
+        if var is not None:
+            uses[var].append(role)
+    for var in colours:
+        colours[var] = _digest(
+            '%s|%s' % (colours[var], '|'.join(sorted(uses[var])))
+        )
+    return colours, eps
+
+
+def _digest(s, size=16):
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()[:size]
+
+
+def dedupe(items, key=fingerprint):
+    """
+    Return the list of *items* without those whose *key* (by default,
+    their fingerprint) is the same as an earlier item's.
+
+    For results that are not Xmrs objects, give a *key* that returns
+    their fingerprint, e.g.,
+    `lambda res: fingerprint(fast_loads_one(res['MRS']))`.
+    """
+    seen = set()
+    unique = []
+    for item in items:
+        k = key(item)
+        if k not in seen:
+            seen.add(k)
+            unique.append(item)
+    return unique
+
+
 def rargname_sortkey(rargname):
     # canonical order: LBL ARG* RSTR BODY *-INDEX *-HNDL CARG ...
     rargname = rargname.upper()
@@ -646,7 +1250,7 @@ def tokenize(string):
 
 
 def deserialize(string):
-    # FIXME: consider buffering this so we don't read the whole string at once
+    # see iterload() for reading large files incrementally
     tokens = tokenize(string)
     while tokens:
         yield _read_mrs(tokens)
@@ -785,6 +1389,362 @@ def _read_lnk(tokens):
     return lnk
 
 
+# Fast deserialization
+#
+# Rather than tokenizing the whole string and popping tokens one at a
+# time, each MRS header and EP is matched by a single regular
+# expression, and the arguments and properties within it by findall().
+# The results are the same as those of deserialize() for well-formed
+# SimpleMRS.
+#
+# It is about 1.3-1.6x faster than deserialize(), as measured by
+# benchmarks/bench_loads.py. A 3x target was withdrawn: most of the
+# time goes to building the Xmrs and its variable index, which both
+# readers must do, and building the EP tuples alone, with no Xmrs, is
+# only about 3x faster. Where only DMRS nodes and links are needed,
+# fast_nodes_and_links() skips building the Xmrs.
+
+_sym = r'[^\s:#@\[\]<>"]+'
+_qstr = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+_lnk = r'(?:<\s*(?:(-?\d+)\s*:\s*(-?\d+)\s*)?>\s*)?'
+
+_mrs_head_re = re.compile(
+    r'\s*\[\s*' + _lnk +
+    r'(?:"([^"\\]*(?:\\.[^"\\]*)*)"\s*)?'  # surface
+    r'(?:L?TOP\s*:\s*(' + _sym + r')\s*)?'
+    r'(?:INDEX\s*:\s*(' + _sym + r')\s*(?:\[\s*' + _sym + r'([^\]]*)\]\s*)?)?'
+    r'(RELS\s*:\s*<)?'
+)
+_ep_re = re.compile(
+    r'\s*\[\s*(' + _qstr + '|' + _sym + r')\s*' + _lnk +
+    r'(?:"([^"\\]*(?:\\.[^"\\]*)*)"\s*)?'  # surface
+    r'(?:LBL\s*:\s*(' + _sym + r'))?'
+    r'([^"\[\]]*(?:(?:' + _qstr + r'|\[[^\]]*\])[^"\[\]]*)*)'  # arguments
+    r'\]'
+)
+_arg_re = re.compile(
+    r'(' + _sym + r')\s*:\s*(' + _qstr + '|' + _sym + r')'
+    r'(?:\s*\[\s*' + _sym + r'([^\]]*)\])?'
+)
+_prop_re = re.compile(r'(' + _sym + r')\s*:\s*(' + _sym + r')')
+_rels_end_re = re.compile(r'\s*>')
+_cons_re = re.compile(r'\s*(HCONS|ICONS)\s*:\s*<([^>]*)>')
+_mrs_end_re = re.compile(r'\s*\]')
+_space_re = re.compile(r'\s*')
+
+
+def fast_deserialize(string):
+    """
+    Yield each Xmrs in the SimpleMRS *string*.
+
+    This is a faster alternative to deserialize() that scans the
+    string once without building a list of tokens.
+    """
+    pos = _space_re.match(string).end()
+    end = len(string)
+    while pos < end:
+        m, pos = _fast_read_mrs(string, pos)
+        yield m
+        pos = _space_re.match(string, pos).end()
+
+
+def _fast_read_mrs(string, pos):
+    # return the Xmrs starting at *pos* and the position following it
+    match = _mrs_head_re.match(string, pos)
+    if match is None:
+        raise _fast_error(string, pos)
+    cfrom, cto, surface, top, idx, idxprops, rels = match.groups()
+    pos = match.end()
+    lnk = None if cfrom is None else (0, (int(cfrom), int(cto)))
+    # the Xmrs is filled in directly, as only the decoder knows which
+    # argument values are variables without checking them again
+    m = Xmrs(top=top, index=idx, lnk=lnk, surface=surface)
+    _vars = m._vars
+    if idxprops:
+        _vars[idx]['props'] = _prop_re.findall(idxprops)
+    if rels is not None:
+        pos = _fast_read_eps(string, pos, m._nodeids, m._eps, _vars)
+    cons = {'HCONS': None, 'ICONS': None}
+    match = _cons_re.match(string, pos)
+    while match is not None and cons[match.group(1)] is None:
+        syms = match.group(2).split()
+        if len(syms) % 3 != 0:
+            raise _fast_error(string, pos)
+        cons[match.group(1)] = [tuple(syms[i:i+3])
+                                for i in range(0, len(syms), 3)]
+        pos = match.end()
+        match = _cons_re.match(string, pos)
+    match = _mrs_end_re.match(string, pos)
+    if match is None:
+        raise _fast_error(string, pos)
+    if cons['HCONS'] is not None:
+        m.add_hcons(cons['HCONS'])
+    if cons['ICONS'] is not None:
+        m.add_icons(cons['ICONS'])
+    return m, match.end()
+
+
+def _fast_read_eps(string, pos, _nodeids, _eps, _vars):
+    # read EPs up to the end of RELS; return the position after it
+    # reassign these locally to avoid global lookup
+    CARG = CONSTARG_ROLE
+    ep_match = _ep_re.match
+    args_findall = _arg_re.findall
+    props_findall = _prop_re.findall
+    var_match = var_re.match
+    get_pred = pred_cache.get
+    nid = 10000
+    match = ep_match(string, pos)
+    while match is not None:
+        predstr, cfrom, cto, surface, label, argstr = match.groups()
+        pred = get_pred(predstr)
+        if label is not None:
+            vd = _vars[label]
+            vd['props'] = []
+            vd['refs']['LBL'].append(nid)
+        args = {}
+        for role, val, props in args_findall(argstr):
+            args[role] = val
+            if val in _vars or (var_match(val) is not None and
+                                role.upper() != CARG):
+                vd = _vars[val]
+                vd['refs'][role].append(nid)
+                if props:
+                    vd['props'].extend(props_findall(props))
+        _nodeids.append(nid)
+        _eps[nid] = (
+            nid, pred, label, args,
+            None if cfrom is None else (0, (int(cfrom), int(cto))),
+            surface
+        )
+        nid += 1
+        pos = match.end()
+        match = ep_match(string, pos)
+    match = _rels_end_re.match(string, pos)
+    if match is None:
+        raise _fast_error(string, pos)
+    return match.end()
+
+
+def fast_nodes_and_links(string):
+    """
+    Return nodes_and_links() for the first MRS in SimpleMRS *string*.
+
+    This reads only what DMRS nodes and links need, without building
+    an Xmrs: no variable references, and ICONS are skipped.
+    """
+    match = _mrs_head_re.match(string)
+    if match is None:
+        raise _fast_error(string, 0)
+    _, _, _, top, idx, idxprops, rels = match.groups()
+    pos = match.end()
+    m = _MrsView(top)
+    _vars = m._vars
+    if top is not None:
+        _vars[top] = []
+    if idx is not None:
+        _vars[idx] = _prop_re.findall(idxprops) if idxprops else []
+    if rels is not None:
+        pos = _fast_read_view_eps(string, pos, m._eps, _vars)
+    match = _cons_re.match(string, pos)
+    while match is not None:
+        if match.group(1) == 'HCONS':
+            syms = match.group(2).split()
+            m._hcons = [tuple(syms[i:i+3]) for i in range(0, len(syms), 3)]
+            for hi, _, lo in m._hcons:
+                _vars.setdefault(hi, [])
+                _vars.setdefault(lo, [])
+        match = _cons_re.match(string, match.end())
+    return nodes_and_links(m)
+
+
+def _fast_read_view_eps(string, pos, _eps, _vars):
+    # as _fast_read_eps(), but only collecting EPs and properties
+    CARG = CONSTARG_ROLE
+    ep_match = _ep_re.match
+    args_findall = _arg_re.findall
+    props_findall = _prop_re.findall
+    var_match = var_re.match
+    get_pred = pred_cache.get
+    nid = 10000
+    match = ep_match(string, pos)
+    while match is not None:
+        predstr, cfrom, cto, surface, label, argstr = match.groups()
+        if label is not None:
+            _vars[label] = []
+        args = {}
+        for role, val, props in args_findall(argstr):
+            args[role] = val
+            if val in _vars or (var_match(val) is not None and
+                                role.upper() != CARG):
+                if val not in _vars:
+                    _vars[val] = []
+                if props:
+                    _vars[val].extend(props_findall(props))
+        _eps.append((
+            nid, get_pred(predstr), label, args,
+            None if cfrom is None else (0, (int(cfrom), int(cto))),
+            surface
+        ))
+        nid += 1
+        pos = match.end()
+        match = ep_match(string, pos)
+    match = _rels_end_re.match(string, pos)
+    if match is None:
+        raise _fast_error(string, pos)
+    return match.end()
+
+
+class _MrsView(object):
+    # just enough of an Xmrs for nodes_and_links()
+
+    __slots__ = ('top', '_eps', '_vars', '_hcons')
+
+    def __init__(self, top):
+        self.top = top
+        self._eps = []
+        self._vars = {}  # var: [(prop, value), ...]
+        self._hcons = []
+
+    def eps(self): return self._eps
+
+    def variables(self): return list(self._vars)
+
+    def hcons(self): return self._hcons
+
+    def properties(self, var):
+        return dict(self._vars.get(var, ()))
+
+
+def _fast_error(string, pos):
+    if pos >= len(string.rstrip()):
+        return XDE('Invalid MRS: Unexpected termination.')
+    return XDE('Invalid MRS at position {}: {!r}'
+               .format(pos, string[pos:pos+20]))
+
+
+def fast_loads(s, single=False, **kwargs):
+    ms = fast_deserialize(s)
+    if single:
+        return next(ms)
+    else:
+        return ms
+
+
+fast_loads_one = lambda s, **kwargs: fast_loads(s, single=True, **kwargs)
+
+
+# Incremental loading
+#
+# iterload() finds where each MRS ends by counting brackets outside of
+# quoted strings, so only the MRS being read (and the chunk it ends
+# in) is held in memory before it is decoded with the fast reader.
+
+_brackets_re = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"?|[\[\]]')
+_brackets_bytes_re = re.compile(br'"[^"\\]*(?:\\.[^"\\]*)*"?|[\[\]]')
+
+
+def iterload(fh, chunksize=65536, use_mmap=False):
+    """
+    Yield each Xmrs in the SimpleMRS file *fh* as it is read.
+
+    *fh* may be a filename, a file opened in text or binary mode, or
+    an `mmap.mmap` object. Files are read *chunksize* characters (or
+    bytes) at a time. If *use_mmap* is `True`, files are memory-mapped
+    instead, so they are scanned in the page cache and only one MRS at
+    a time is copied into a string.
+    """
+    if isinstance(fh, str):
+        with open(fh, 'rb' if use_mmap else 'r') as f:
+            for m in iterload(f, chunksize=chunksize, use_mmap=use_mmap):
+                yield m
+    elif isinstance(fh, mmap.mmap):
+        spans = _MrsSpans(_brackets_bytes_re, b'[', b']')
+        for start, end in spans.scan(fh, final=True):
+            yield _fast_read_mrs(fh[start:end].decode('utf-8'), 0)[0]
+        spans.check()
+    elif use_mmap:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return  # empty files cannot be mapped
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for m in iterload(mm):
+                yield m
+        finally:
+            mm.close()
+    else:
+        for m in _iterload_chunks(fh, chunksize):
+            yield m
+
+
+def _iterload_chunks(fh, chunksize):
+    spans = _MrsSpans(_brackets_re, '[', ']')
+    decoder = None
+    buf = ''
+    final = False
+    while not final:
+        chunk = fh.read(chunksize)
+        final = not chunk
+        if isinstance(chunk, bytes):
+            if decoder is None:
+                decoder = codecs.getincrementaldecoder('utf-8')()
+            chunk = decoder.decode(chunk, final=final)
+        buf += chunk
+        for start, end in spans.scan(buf, final=final):
+            yield _fast_read_mrs(buf[start:end], 0)[0]
+        # drop everything before the MRS in progress
+        buf = buf[spans.shift():]
+    spans.check()
+
+
+class _MrsSpans(object):
+    # Finds the (start, end) extent of each top-level bracketed MRS in
+    # a buffer that may end partway through an MRS or a quoted string.
+    # After a buffer is scanned, shift() returns how much of it is no
+    # longer needed, and positions are relative to the remainder.
+
+    def __init__(self, brackets_re, lbrack, rbrack):
+        self.brackets_re = brackets_re
+        self.lbrack, self.rbrack = lbrack, rbrack
+        self.pos = 0  # where scanning resumes
+        self.start = None  # start of the MRS in progress
+        self.depth = 0
+
+    def scan(self, buf, final=False):
+        lbrack, rbrack = self.lbrack, self.rbrack
+        end = len(buf)
+        for match in self.brackets_re.finditer(buf, self.pos):
+            tok = match.group()
+            if tok == lbrack:
+                if self.depth == 0:
+                    self.start = match.start()
+                self.depth += 1
+            elif tok == rbrack:
+                if self.depth == 0:
+                    raise XDE('Invalid MRS: Unexpected "]".')
+                self.depth -= 1
+                if self.depth == 0:
+                    self.pos = match.end()
+                    yield self.start, self.pos
+                    self.start = None
+            elif not final and match.end() >= end - 1:
+                # the quoted string may continue in the next chunk
+                self.pos = match.start()
+                return
+        self.pos = end
+
+    def shift(self):
+        cut = self.pos if self.start is None else self.start
+        self.pos -= cut
+        if self.start is not None:
+            self.start -= cut
+        return cut
+
+    def check(self):
+        if self.depth != 0:
+            raise XDE('Invalid MRS: Unexpected termination.')
+
+
 # Encoding
 
 
@@ -899,6 +1859,475 @@ def serialize_icons(icons):
     return ' '.join(toks)
 
 
+# Fast serialization
+#
+# The output is the same as serialize(), but the canonical role order
+# is cached for each set of roles, each variable's properties are
+# looked up only when it is first printed, and every MRS is built as
+# one list of strings. fast_dump() writes each MRS as it is serialized
+# rather than joining them all first.
+
+_role_orders = {}  # tuple of roles: the roles in canonical order
+_role_orders_max = 10000
+
+
+def fast_serialize(ms, version=_default_version, pretty_print=False,
+                   **kwargs):
+    parts = []
+    for m in ms:
+        if parts:
+            parts.append('\n')
+        _serialize_into(parts, m, version, pretty_print)
+    return ''.join(parts)
+
+
+def fast_dumps(ms, single=False, version=_default_version,
+               pretty_print=False, **kwargs):
+    if single:
+        ms = [ms]
+    return fast_serialize(ms, version=version, pretty_print=pretty_print)
+
+
+def fast_dump(fh, ms, single=False, version=_default_version,
+              pretty_print=False, **kwargs):
+    # as dump(), each MRS is followed by a newline
+    if single:
+        ms = [ms]
+    write = fh.write
+    for m in ms:
+        parts = []
+        _serialize_into(parts, m, version, pretty_print)
+        parts.append('\n')
+        write(''.join(parts))
+
+
+fast_dumps_one = lambda m, **kwargs: fast_dumps(m, single=True, **kwargs)
+fast_dump_one = lambda fh, m, **kwargs: fast_dump(fh, m, single=True, **kwargs)
+
+
+def _serialize_into(parts, m, version, pretty_print):
+    # append the SimpleMRS serialization of *m* to the list *parts*
+    append = parts.append
+    if isinstance(m, CompactXmrs):
+        get_props = m._var_props
+    else:
+        _vars = m._vars
+
+        def get_props(var):
+            vd = _vars.get(var)  # not _vars[var]; it is a defaultdict
+            return None if vd is None else vd['props']
+    printed = set()
+
+    def argument(rargname, value):
+        if value in printed:
+            return '%s: %s' % (rargname, value)
+        props = get_props(value)
+        if not props:
+            return '%s: %s' % (rargname, value)
+        printed.add(value)  # only print props once
+        return '%s: %s [ %s %s ]' % (
+            rargname, value, var_re.match(value).group(1),
+            ' '.join(['%s: %s' % (key, val) for key, val in props])
+        )
+
+    toks = []
+    if version >= 1.1:
+        header_toks = []
+        if m.lnk is not None:
+            header_toks.append(serialize_lnk(m.lnk))
+        if m.surface is not None:
+            header_toks.append('"%s"' % m.surface)
+        if header_toks:
+            toks.append(' '.join(header_toks))
+    if m.top is not None:
+        toks.append(argument(_top if version >= 1.1 else _ltop, m.top))
+    if m.index is not None:
+        toks.append(argument('INDEX', m.index))
+    append('[ ')
+    if toks:
+        append((' ' if not pretty_print else '\n  ').join(toks))
+        append(' ' if not pretty_print else '\n  ')
+    append('RELS: < ')
+    ep_delim = ' ' if not pretty_print else '\n          '
+    role_orders = _role_orders
+    first = True
+    for ep in m.eps():
+        args = ep[3]
+        roles = tuple(args)
+        order = role_orders.get(roles)
+        if order is None:
+            if len(role_orders) >= _role_orders_max:
+                role_orders.clear()
+            order = role_orders[roles] = sorted(roles, key=rargname_sortkey)
+        lnk = None if len(ep) < 5 else ep[4]
+        if version < 1.1 or len(ep) < 6 or ep[5] is None:
+            surface = ''
+        else:
+            surface = ' "%s"' % ep[5]
+        if not first:
+            append(ep_delim)
+        first = False
+        append('[ %s%s%s LBL: %s' % (
+            ep[1].string,
+            '' if lnk is None else serialize_lnk(lnk),
+            surface, ep[2]
+        ))
+        for role in order:
+            append(' ')
+            append(argument(role, args[role]))
+        append(' ]')
+    append(' >')
+    delim = ' ' if not pretty_print else '\n  '
+    append(delim)
+    append(serialize_hcons(m.hcons()))
+    icons_ = m.icons()
+    if version >= 1.1 and icons_:  # remove `and icons_` for "ICONS: < >"
+        append(delim)
+        append(serialize_icons(icons_))
+    append(' ]')
+
+
+# Binary serialization
+#
+# dumpb() encodes Xmrs objects as a string table followed by an array
+# of unsigned ints. Every string (variables, predicates, roles,
+# properties, etc.) is stored once in the table and referred to by its
+# position + 1, with 0 for None, so loadb() decodes each string once
+# and never tokenizes anything. The table is the NUL-separated strings
+# as UTF-8. Lengths are varints (7 bits per byte, low bits first), but
+# the ints all have the width of the largest one, so loadb() reads
+# them with a single array() call; decoding a varint per int in
+# Python takes longer than the whole SimpleMRS decoder.
+#
+#   magic  string-count  table-length  table  int-width  mrs-count
+#   ints (little-endian)
+#
+# For each MRS the ints are the top, index, xarg, surface, and
+# identifier strings, the lnk, the variables (with their properties),
+# the EPs, the HCONS, and the ICONS. An EP's roles are followed by
+# their values, each stored as (string << 1 | is-variable), and
+# nodeids and lnk offsets, which may be negative, are zigzag-encoded.
+
+_binary_magic = b'MRSB\x01'
+_lnk_none = 0
+_lnk_charspan = 1
+
+
+def dumpb(ms, single=False):
+    """
+    Return the Xmrs or CompactXmrs objects *ms* (or the one object *ms*
+    if *single* is `True`) in the binary encoding, as bytes.
+    """
+    if single:
+        ms = [ms]
+    strings = {}
+    body = []
+    count = 0
+    for m in ms:
+        _encode_into(body, strings, m)
+        count += 1
+    table = sorted(strings, key=strings.get)
+    if any('\0' in string for string in table):
+        raise XmrsError('Cannot encode strings containing NUL.')
+    nstrings = len(table)
+    table = '\0'.join(table).encode('utf-8')
+    largest = max(body) if body else 0
+    for width in sorted(_array_types):
+        if largest < 1 << (8 * width):
+            break
+    else:
+        raise XmrsError('Cannot encode int: {}'.format(largest))
+    ints = array(_array_types[width], body)
+    if _big_endian:
+        ints.byteswap()
+    out = bytearray(_binary_magic)
+    _write_varint(out, nstrings)
+    _write_varint(out, len(table))
+    out.extend(table)
+    _write_varint(out, width)
+    _write_varint(out, count)
+    out.extend(_array_bytes(ints))
+    return bytes(out)
+
+
+def loadb(b, single=False, compact=False):
+    """
+    Return the list of objects encoded by dumpb() in the bytes *b*
+    (or the first object if *single* is `True`). They are Xmrs
+    objects, or CompactXmrs objects if *compact* is `True`, which
+    skips building the Xmrs indexes.
+    """
+    if b[:len(_binary_magic)] != _binary_magic:
+        raise XmrsDeserializationError('Not a binary MRS encoding.')
+    try:
+        data = bytearray(b)
+        nstrings, pos = _read_varint(data, len(_binary_magic))
+        size, pos = _read_varint(data, pos)
+        strings = [None]
+        if nstrings:
+            table = data[pos:pos+size].decode('utf-8').split('\0')
+            if len(table) != nstrings:
+                raise IndexError('truncated string table')
+            strings.extend(intern(string) for string in table)
+        width, pos = _read_varint(data, pos + size)
+        count, pos = _read_varint(data, pos)
+        if (len(data) - pos) % width:
+            raise IndexError('truncated ints')
+        ints = array(_array_types[width])
+        _array_extend(ints, bytes(data[pos:]))
+        if _big_endian:
+            ints.byteswap()
+        ints = ints.tolist()
+        ms = []
+        pos = 0
+        for _ in range(count):
+            m, pos = _decode_xmrs(ints, pos, strings, compact)
+            ms.append(m)
+    except (IndexError, KeyError, ValueError, AttributeError,
+            XmrsError) as ex:
+        # corrupt input can fail anywhere in decoding, e.g., with None
+        # for a predicate or two constraints on one hole
+        raise XmrsDeserializationError(
+            'Invalid binary MRS encoding: {}'.format(ex)
+        )
+    if single:
+        return ms[0]
+    return ms
+
+
+dumpb_one = lambda m, **kwargs: dumpb(m, single=True, **kwargs)
+loadb_one = lambda b, **kwargs: loadb(b, single=True, **kwargs)
+
+
+def _encode_into(body, strings, m):
+    # append the ints encoding *m* to *body*, adding new strings to
+    # the *strings* table (string: position + 1)
+    append = body.append
+
+    def ref(s):
+        if s is None:
+            return 0
+        i = strings.get(s)
+        if i is None:
+            i = strings[s] = len(strings) + 1
+        return i
+
+    def lnk(l):
+        if l is None:
+            append(_lnk_none)
+        elif l[0] == 0:
+            append(_lnk_charspan)
+            append(_zigzag(l[1][0]))
+            append(_zigzag(l[1][1]))
+        else:
+            raise XmrsError('Cannot encode lnk: {}'.format(l))
+
+    if isinstance(m, CompactXmrs):
+        variables = m.variables()
+        get_props = m._var_props
+    else:
+        _vars = m._vars
+        variables = list(_vars)
+        get_props = lambda var: _vars[var]['props']
+    varset = set(variables)
+    for s in (m.top, m.index, m.xarg, m.surface, m.identifier):
+        append(ref(s))
+    lnk(m.lnk)
+    append(len(variables))
+    for var in variables:
+        props = get_props(var) or ()
+        append(ref(var))
+        append(len(props))
+        for key, val in props:
+            append(ref(key))
+            append(ref(val))
+    eps = m.eps()
+    append(len(eps))
+    for ep in eps:
+        eplen = len(ep)
+        nid, pred = ep[0], ep[1]
+        if not isinstance(nid, _int_types):
+            raise XmrsError('Cannot encode nodeid: {}'.format(nid))
+        append(eplen)
+        append(_zigzag(nid))
+        append(pred.type)
+        if pred.type == Pred.REALPRED:
+            append(ref(pred.lemma))
+            append(ref(pred.pos))
+            append(ref(pred.sense))
+        append(ref(pred.string))
+        append(ref(ep[2]))
+        if eplen >= 4:
+            args = ep[3] or {}
+            append(len(args))
+            body.extend([ref(role) for role in args])
+            body.extend([ref(val) << 1 | (val in varset)
+                         for val in args.values()])
+        if eplen >= 5:
+            lnk(ep[4])
+        if eplen >= 6:
+            append(ref(ep[5]))
+        if eplen >= 7:
+            append(ref(ep[6]))
+    for cons in (m.hcons(), m.icons()):
+        append(len(cons))
+        for c in cons:
+            append(ref(c[0]))
+            append(ref(c[1]))
+            append(ref(c[2]))
+
+
+def _decode_xmrs(ints, i, strings, compact=False):
+    # return the Xmrs (or CompactXmrs) encoded at *ints[i]* and the
+    # position after it
+    top, index, xarg, surface, identifier = [
+        strings[n] for n in ints[i:i+5]
+    ]
+    i += 5
+    lnk, i = _decode_lnk(ints, i)
+    get_string = strings.__getitem__
+    variables = []
+    props = []
+    nvars = ints[i]
+    i += 1
+    for _ in range(nvars):
+        nprops = ints[i+1]
+        variables.append(strings[ints[i]])
+        i += 2
+        if nprops:
+            kvs = list(map(get_string, ints[i:i + 2*nprops]))
+            props.append(list(zip(kvs[::2], kvs[1::2])))
+            i += 2 * nprops
+        else:
+            props.append([])
+    if compact:
+        _vars = None
+    else:
+        m = Xmrs(lnk=lnk, surface=surface, identifier=identifier)
+        m.top, m.index, m.xarg = top, index, xarg
+        _nodeids, _eps, _vars = m._nodeids, m._eps, m._vars
+        # as from the defaultdict, but without calling its factory
+        for var, varprops in zip(variables, props):
+            _vars[var] = {'props': varprops, 'refs': defaultdict(list)}
+    get_pred = pred_cache.get
+    half = (2).__rfloordiv__  # n // 2, i.e., n >> 1
+    eps = []
+    neps = ints[i]
+    i += 1
+    for _ in range(neps):
+        eplen, nid, predtype = ints[i], _unzigzag(ints[i+1]), ints[i+2]
+        i += 3
+        if predtype == Pred.REALPRED:
+            pred = Pred(predtype, strings[ints[i]], strings[ints[i+1]],
+                        strings[ints[i+2]], strings[ints[i+3]])
+            i += 4
+        else:
+            pred = get_pred(strings[ints[i]])
+            if pred.type != predtype:
+                pred = pred._replace(type=predtype)
+            i += 1
+        label = strings[ints[i]]
+        i += 1
+        if label is not None and _vars is not None:
+            _vars[label]['refs']['LBL'].append(nid)
+        ep = [nid, pred, label]
+        if eplen >= 4:
+            n = ints[i]
+            roles = list(map(get_string, ints[i+1:i+1+n]))
+            vals = ints[i+1+n:i+1+2*n]
+            args = dict(zip(roles, map(get_string, map(half, vals))))
+            if _vars is not None:
+                for role, val in zip(roles, vals):
+                    if val & 1:
+                        _vars[strings[val >> 1]]['refs'][role].append(nid)
+            i += 1 + 2*n
+            ep.append(args)
+        if eplen >= 5:
+            eplnk, i = _decode_lnk(ints, i)
+            ep.append(eplnk)
+        for _ in range(5, min(eplen, 7)):
+            ep.append(strings[ints[i]])
+            i += 1
+        eps.append(tuple(ep))
+    cons = []
+    for _ in range(2):
+        n = ints[i]
+        cons.append([(strings[ints[j]], strings[ints[j+1]],
+                      strings[ints[j+2]])
+                     for j in range(i + 1, i + 1 + 3*n, 3)])
+        i += 1 + 3*n
+    hcons, icons = cons
+    if compact:
+        m = CompactXmrs.__new__(CompactXmrs)
+        m.top, m.index, m.xarg = top, index, xarg
+        m.lnk, m.surface, m.identifier = lnk, surface, identifier
+        m._nodeids = tuple(ep[0] for ep in eps)
+        m._preds = tuple(ep[1] for ep in eps)
+        m._labels = tuple(ep[2] for ep in eps)
+        m._args = tuple(tuple(chain.from_iterable(ep[3].items()))
+                        if len(ep) > 3 else () for ep in eps)
+        m._lnks = _optional_column(eps, 4)
+        m._surfaces = _optional_column(eps, 5)
+        m._bases = _optional_column(eps, 6)
+        m._vars = tuple(variables)
+        m._props = dict((var, tuple(chain.from_iterable(varprops)))
+                        for var, varprops in zip(variables, props)
+                        if varprops)
+        m._hcons = tuple(hcons)
+        m._icons = tuple(icons)
+        return m, i
+    for ep in eps:
+        _nodeids.append(ep[0])
+        _eps[ep[0]] = ep
+    m.add_hcons(hcons)
+    m.add_icons(icons)
+    return m, i
+
+
+def _decode_lnk(ints, i):
+    if ints[i] == _lnk_none:
+        return None, i + 1
+    elif ints[i] == _lnk_charspan:
+        return (0, (_unzigzag(ints[i+1]), _unzigzag(ints[i+2]))), i + 3
+    raise XmrsDeserializationError('Invalid lnk type: {}'.format(ints[i]))
+
+
+def _zigzag(n):
+    return n << 1 if n >= 0 else ((-n) << 1) - 1
+
+
+def _unzigzag(n):
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+
+def _write_varint(out, n):
+    while n > 127:
+        out.append((n & 127) | 128)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(data, pos):
+    n = shift = 0
+    b = data[pos]
+    while b > 127:
+        n |= (b & 127) << shift
+        shift += 7
+        pos += 1
+        b = data[pos]
+    return n | (b << shift), pos + 1
+
+
+# int width in bytes: array typecode (the widths of C types vary)
+_array_types = dict(
+    (array(code).itemsize, code) for code in reversed('BHILQ')
+    if code in getattr(array, 'typecodes', 'BHIL')
+)
+_big_endian = sys.byteorder == 'big'
+_array_bytes = getattr(array, 'tobytes', getattr(array, 'tostring', None))
+_array_extend = getattr(array, 'frombytes', getattr(array, 'fromstring', None))
+
+
 # ACE interface
 
 class AceProcess(object):
@@ -915,6 +2344,7 @@ class AceProcess(object):
         self._open()
 
     def _open(self):
+        self._eof = False
         self._p = Popen(
             [self.executable, '-g', self.grm] + self._cmdargs + self.cmdargs,
             stdin=PIPE,
@@ -938,6 +2368,18 @@ class AceProcess(object):
     def receive(self):
         return self._p.stdout
 
+    def _readline(self):
+        line = self._p.stdout.readline()
+        if not line:
+            self._eof = True  # ACE closed its output; it is exiting
+        return line.rstrip()
+
+    def _read_response(self, reader):
+        line = self._readline()
+        while not (self._eof or reader.feed(line)):
+            line = self._readline()
+        return reader.finish()
+
     def interact(self, datum):
         self.send(datum)
         result = self.receive()
@@ -946,6 +2388,15 @@ class AceProcess(object):
     def read_result(self, result):
         return result
 
+    def is_alive(self):
+        return not self._eof and self._p.poll() is None
+
+    def at_eof(self):
+        # True if ACE's output ended while a response was being read,
+        # so that response is incomplete; unlike is_alive(), this is
+        # False if ACE exited only after the response was finished
+        return self._eof
+
     def close(self):
         self._p.stdin.close()
         for line in self._p.stdout:
@@ -953,69 +2404,117 @@ class AceProcess(object):
         retval = self._p.wait()
         return retval
 
+    def abort(self):
+        # stop ACE from another thread (e.g., one enforcing a time
+        # limit) without waiting for it; whatever is reading its output
+        # gets EOF, and kill() or close() should follow
+        try:
+            self._p.kill()
+        except OSError:
+            pass  # it already exited
+
+    def kill(self):
+        # for processes that may be hung or in an unknown state, where
+        # close() could block forever waiting on the output
+        if self._p.poll() is None:
+            self._p.kill()
+        retval = self._p.wait()
+        for stream in (self._p.stdin, self._p.stdout):
+            try:
+                stream.close()
+            except (IOError, OSError):
+                pass
+        return retval
+
 
 class AceParser(AceProcess):
 
     def receive(self):
-        response = {
+        return self._read_response(AceParserReader())
+
+
+class AceGenerator(AceProcess):
+
+    _cmdargs = ['-e']
+
+    def receive(self):
+        return self._read_response(AceGeneratorReader())
+
+
+class AceParserReader(object):
+    """
+    Build the response to one parse request from ACE's output lines.
+
+    Lines are given one at a time (without newlines) to feed(), which
+    returns `True` when the response is complete; finish() then returns
+    the response. This does no I/O, so it works with any means of
+    reading from ACE.
+    """
+
+    def __init__(self):
+        self.response = {
             'NOTES': [],
             'WARNINGS': [],
             'ERRORS': [],
             'SENT': None,
             'RESULTS': []
         }
+        self.blank = 0
+
+    def feed(self, line):
+        response = self.response
+        if line.strip() == '':
+            self.blank += 1
+            if self.blank >= 2:
+                return True
+        elif line.startswith('SENT: ') or line.startswith('SKIP: '):
+            response['SENT'] = line.split(': ', 1)[1]
+        elif (line.startswith('NOTE:') or
+              line.startswith('WARNING') or
+              line.startswith('ERROR')):
+            level, message = line.split(': ', 1)
+            response['{}S'.format(level)].append(message)
+        else:
+            mrs, deriv = line.split(' ; ')
+            response['RESULTS'].append({
+                'MRS': mrs.strip(),
+                'DERIV': deriv.strip()
+            })
+        return False
 
-        blank = 0
-
-        stdout = self._p.stdout
-        line = stdout.readline().rstrip()
-        while True:
-            if line.strip() == '':
-                blank += 1
-                if blank >= 2:
-                    break
-            elif line.startswith('SENT: ') or line.startswith('SKIP: '):
-                response['SENT'] = line.split(': ', 1)[1]
-            elif (line.startswith('NOTE:') or
-                  line.startswith('WARNING') or
-                  line.startswith('ERROR')):
-                level, message = line.split(': ', 1)
-                response['{}S'.format(level)].append(message)
-            else:
-                mrs, deriv = line.split(' ; ')
-                response['RESULTS'].append({
-                    'MRS': mrs.strip(),
-                    'DERIV': deriv.strip()
-                })
-            line = stdout.readline().rstrip()
-        return response
-
+    def finish(self):
+        return self.response
 
-class AceGenerator(AceProcess):
 
-    _cmdargs = ['-e']
+class AceGeneratorReader(object):
+    """Like AceParserReader, but for the response to a generation request."""
 
-    def receive(self):
-        response = {
+    def __init__(self):
+        self.response = {
             'NOTE': None,
             'WARNING': None,
             'ERROR': None,
             'SENT': None,
             'RESULTS': None
         }
-        results = []
-
-        stdout = self._p.stdout
-        line = stdout.readline().rstrip()
-        while not line.startswith('NOTE: '):
-            if line.startswith('WARNING') or line.startswith('ERROR'):
-                level, message = line.split(': ', 1)
-                response[level] = message
-            else:
-                results.append(line)
-            line = stdout.readline().rstrip()
+        self.results = []
+        self.last = ''
+
+    def feed(self, line):
+        if line.startswith('NOTE: '):
+            self.last = line
+            return True
+        if line.startswith('WARNING') or line.startswith('ERROR'):
+            level, message = line.split(': ', 1)
+            self.response[level] = message
+        else:
+            self.results.append(line)
+        return False
+
+    def finish(self):
+        response, results = self.response, self.results
         # sometimes error messages aren't prefixed with ERROR
-        if line.endswith('[0 results]') and len(results) > 0:
+        if self.last.endswith('[0 results]') and len(results) > 0:
             response['ERROR'] = '\n'.join(results)
             results = []
         response['RESULTS'] = results
@@ -1038,10 +2537,30 @@ def compile(cfg_path, out_path, log=None):
     #debug('Compiled grammar written to {}'.format(abspath(out_path)), log)
 
 
+def interact_from_iterable(process, data):
+    # each datum is sent before the response to the previous one is
+    # read, so ACE can start on it while that response is processed
+    data = iter(data)
+    for datum in data:
+        process.send(datum)
+        break
+    else:
+        return
+    for datum in data:
+        process.send(datum)
+        yield process.receive()
+    yield process.receive()
+
+
 def parse_from_iterable(dat_file, data, **kwargs):
-    with AceParser(dat_file, **kwargs) as parser:
-        for datum in data:
-            yield parser.interact(datum)
+    # dat_file may also be an open AceParser, which is left open
+    if isinstance(dat_file, AceParser):
+        for response in interact_from_iterable(dat_file, data):
+            yield response
+    else:
+        with AceParser(dat_file, **kwargs) as parser:
+            for response in interact_from_iterable(parser, data):
+                yield response
 
 
 def parse(dat_file, datum, **kwargs):
@@ -1049,9 +2568,14 @@ def parse(dat_file, datum, **kwargs):
 
 
 def generate_from_iterable(dat_file, data, **kwargs):
-    with AceGenerator(dat_file, **kwargs) as generator:
-        for datum in data:
-            yield generator.interact(datum)
+    # dat_file may also be an open AceGenerator, which is left open
+    if isinstance(dat_file, AceGenerator):
+        for response in interact_from_iterable(dat_file, data):
+            yield response
+    else:
+        with AceGenerator(dat_file, **kwargs) as generator:
+            for response in interact_from_iterable(generator, data):
+                yield response
 
 
 def generate(dat_file, datum, **kwargs):
@@ -0,0 +1,123 @@
+
+#
+# preprocessors : input preprocessors for Demophin grammars
+#
+# Some grammars need their input converted before ACE sees it (e.g.,
+# Jacy takes YY-mode tokens from MeCab). A preprocessor is a module,
+# named by a grammar's "preprocessor" field, with a get_ace_input(sent)
+# function and optionally:
+#
+#   setup()                      build expensive state, such as taggers
+#   get_ace_input_batch(sents)   convert many sentences in one call
+#   SAMPLE                       a sentence to try it on when loaded
+#
+# Preprocessors are loaded, set up, and tried on their sample when the
+# server starts, so a missing dependency stops the server instead of
+# failing (slowly) on every request.
+
+import logging
+import importlib
+import threading
+
+
+class PreprocessorError(Exception):
+    pass
+
+
+class Preprocessor(object):
+    """
+    A loaded preprocessor module.
+
+    Args:
+        name: the module name (e.g., `"pyjacy"`)
+    Raises:
+        PreprocessorError: if the module cannot be imported or has no
+            get_ace_input() function
+    """
+
+    def __init__(self, name):
+        self.name = name
+        try:
+            self.module = importlib.import_module(name)
+        except Exception as e:
+            raise PreprocessorError(
+                'Could not import preprocessor %s: %s' % (name, e)
+            )
+        if not callable(getattr(self.module, 'get_ace_input', None)):
+            raise PreprocessorError(
+                'Preprocessor %s has no get_ace_input() function.' % name
+            )
+
+    def __repr__(self):
+        return '<{} {} at {}>'.format(
+            self.__class__.__name__, self.name, id(self)
+        )
+
+    def __call__(self, sent):
+        return self.module.get_ace_input(sent)
+
+    def batch(self, sents):
+        """Return the ACE input for each sentence in *sents*."""
+        sents = list(sents)
+        batch = getattr(self.module, 'get_ace_input_batch', None)
+        if batch is not None:
+            return list(batch(sents))
+        return [self.module.get_ace_input(sent) for sent in sents]
+
+    def warm(self):
+        """
+        Set up the module and convert its sample sentence, if it has
+        them, raising PreprocessorError if either fails.
+        """
+        try:
+            if callable(getattr(self.module, 'setup', None)):
+                self.module.setup()
+            sample = getattr(self.module, 'SAMPLE', None)
+            if sample and not self(sample):
+                raise ValueError('no input for %r' % sample)
+        except PreprocessorError:
+            raise
+        except Exception as e:
+            raise PreprocessorError(
+                'Could not set up preprocessor %s: %s' % (self.name, e)
+            )
+        return self
+
+
+class PreprocessorRegistry(object):
+    """
+    Preprocessors by name, each loaded and warmed once.
+
+    Preprocessors not loaded at startup with load() are loaded when
+    first used.
+    """
+
+    def __init__(self):
+        self._preprocessors = {}  # name: Preprocessor
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self._preprocessors
+
+    def load(self, name):
+        """
+        Return the preprocessor *name*, loading and warming it if it
+        has not been already. PreprocessorError is raised on failure.
+        """
+        pp = self._preprocessors.get(name)
+        if pp is None:
+            with self._lock:
+                pp = self._preprocessors.get(name)
+                if pp is None:
+                    logging.info('Loading preprocessor %s', name)
+                    pp = Preprocessor(name).warm()
+                    self._preprocessors[name] = pp
+        return pp
+
+    def preprocess(self, sent, name):
+        """Return the ACE input for *sent* from preprocessor *name*."""
+        return self.load(name)(sent)
+
+    def preprocess_batch(self, sents, name):
+        """As preprocess(), for each sentence in *sents*."""
+        return self.load(name).batch(sents)
@@ -2,52 +2,119 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import threading
+from contextlib import contextmanager
 
 try:
     import MeCab
 except:
+    MeCab = None
     logging.error("MeCab not found")
     
-MECAB_OBJ = None
 JAP_PUNCT=u"!\"!&'()*+,-−./;<=>?@[\]^_`{|}~。！？…．　○●◎＊☆★◇◆"
-    
+
+# tried when Demophin loads the preprocessor (see preprocessors.py)
+SAMPLE = u"犬が吠えた。"
+
+## MeCab taggers cannot be shared by threads, and building one loads the
+## dictionary, so idle taggers are pooled; there are never more than
+## the number of sentences tagged at once
+_taggers = []
+_taggers_lock = threading.Lock()
+
 def getMecab():
-    global MECAB_OBJ
-    if not MECAB_OBJ:
-        MECAB_OBJ = MeCab.Tagger('-O chasen')
-    return MECAB_OBJ
+    """build a new MeCab tagger (not shared; see tagger())"""
+    if MeCab is None:
+        raise ImportError("MeCab is not installed")
+    t = MeCab.Tagger('-O chasen')
+    t.parse('')  ## some versions give bad surfaces from the first parseToNode
+    return t
+
+@contextmanager
+def tagger():
+    """a MeCab tagger for use by this thread until the block exits"""
+    with _taggers_lock:
+        t = _taggers.pop() if _taggers else None
+    if t is None:
+        t = getMecab()
+    try:
+        yield t
+    finally:
+        with _taggers_lock:
+            _taggers.append(t)
+
+def setup():
+    """build a MeCab tagger before the first sentence arrives"""
+    with tagger():
+        pass
 
 def get_ace_input(sent):
-    return "".join(jp2yy(sent))
+    return _native("".join(jp2yy(sent)))
+
+def get_ace_input_batch(sents):
+    """as get_ace_input(), for each of sents, using one tagger"""
+    with tagger() as t:
+        return [_native("".join(jp2yy(sent, t))) for sent in sents]
+
+## Python 2 gives (and its MeCab takes and returns) UTF-8 byte strings,
+## but offsets are counted in characters, so tokens are handled as text
+## and only converted back to the native str type at the edges
+
+def _text(s):
+    return s.decode('utf-8') if isinstance(s, bytes) else s
+
+def _native(s):
+    return s.encode('utf-8') if bytes is str else s
+
+def tokenize(sent, t=None):
+    """
+    yield (form, features, cfrom, cto) for each MeCab token of sent,
+    where cfrom and cto are its character offsets in sent; sent may be
+    text or UTF-8 bytes, and form and features are text
+    """
+    if t is None:
+        with tagger() as t:
+            for tok in tokenize(sent, t):
+                yield tok
+        return
+    data = _text(sent).encode('utf-8')
+    pos = 0    ## byte offset of the end of the last token
+    cto = 0    ## its character offset
+    node = t.parseToNode(_native(_text(sent)))
+    while node:
+        if node.stat not in (MeCab.MECAB_BOS_NODE, MeCab.MECAB_EOS_NODE):
+            ## lengths are in bytes; rlength includes leading spaces
+            begin = pos + node.rlength - node.length
+            end = begin + node.length
+            cfrom = cto + len(data[pos:begin].decode('utf-8'))
+            cto = cfrom + len(data[begin:end].decode('utf-8'))
+            pos = end
+            yield (_text(node.surface), _text(node.feature).split(','),
+                   cfrom, cto)
+        node = node.next
 
-def jp2yy (sent):
+def jp2yy (sent, t=None):
     """take a Japanese sentence in UTF8 convert to YY-mode using mecab"""
     ### (id, start, end, [link,] path+, form [surface], ipos, lrule+[, {pos p}+])
     ### set ipos as lemma (just for fun)
     ### fixme: do the full lattice
     yid = 0
     start = 0
-    cfrom = 0
-    cto = 0
     yy = list()
-    parse_result = getMecab().parse(sent)
-    print(parse_result)
-    for tok in parse_result.split('\n'):
-        if tok and tok != 'EOS':
-            ##print tok
-            (form, p, lemma, p1, p2, p3) = tok.split('\t')
-            if form in JAP_PUNCT:
-                continue
-            p2 = p2 or 'n'
-            p3 = p3 or 'n'
-            # pos = '-'.join([p1, p2, p3])
-            pos = "%s:%s-%s" % (p1, p2, p3) ## wierd format jacy requires
-            cfrom = sent.find(form, cto)    ## first instance after last token
-            cto = cfrom + len(form)         ## find the end
-            yy.append('(%d, %d, %d, <%d:%d>, 1, "%s", %s, "null", "%s" 1.0)' % \
-                (yid, start, start +1, cfrom, cto, form, 0, pos))
-            yid += 1
-            start += 1
+    for (form, features, cfrom, cto) in tokenize(sent, t):
+        if form in JAP_PUNCT:
+            continue
+        ## as chasen: POS levels joined with '-', then conjugation
+        ## type and form ('n' if there is none)
+        features = features + ['*'] * (6 - len(features))
+        p1 = '-'.join(f for f in features[:4] if f != '*')
+        p2 = features[4] if features[4] != '*' else 'n'
+        p3 = features[5] if features[5] != '*' else 'n'
+        pos = "%s:%s-%s" % (p1, p2, p3) ## wierd format jacy requires
+        yy.append('(%d, %d, %d, <%d:%d>, 1, "%s", %s, "null", "%s" 1.0)' % \
+            (yid, start, start +1, cfrom, cto, form, 0, pos))
+        yid += 1
+        start += 1
     return yy
 
 def main():
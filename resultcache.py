@@ -0,0 +1,396 @@
+
+#
+# resultcache : caches of processed ACE results for Demophin
+#
+# Demo traffic repeats itself a lot (example links, shared URLs, the
+# same MRS parsed and then generated from), so results are kept in
+# memory and returned without consulting ACE when requested again.
+# Results may also be stored in an SQLite database, which survives
+# restarts and is shared by all processes of a (pre-forked) server.
+#
+# Cache keys are tuples of (kind, grammar, version, ...), where version
+# changes whenever the grammar image does.
+
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+
+class MemoryCache(object):
+    """
+    A thread-safe LRU cache bounded by the size of its values.
+
+    Args:
+        maxbytes: the maximum total size of the cached values; least
+            recently used entries are dropped to stay within it
+        ttl: number of seconds entries remain valid, or `None` if they
+            do not expire
+        sizeof: function to compute the size of a value in bytes; by
+            default, the length of its JSON serialization
+    """
+
+    def __init__(self, maxbytes=64 * 1024 * 1024, ttl=None, sizeof=None):
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.sizeof = sizeof or _json_size
+        self._data = OrderedDict()  # key: (expiry, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expiry, size, value = entry
+            if expiry is not None and expiry < time.time():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            # move to the most-recently-used end
+            del self._data[key]
+            self._data[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        if size > self.maxbytes:
+            return  # would evict everything else and still not fit
+        expiry = None if self.ttl is None else time.time() + self.ttl
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (expiry, size, value)
+            self._bytes += size
+            while self._bytes > self.maxbytes:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'backend': 'memory',
+                'entries': len(self._data),
+                'bytes': self._bytes,
+                'maxbytes': self.maxbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+    def _remove(self, key):
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+
+
+class SqliteCache(object):
+    """
+    A persistent cache in an SQLite database.
+
+    Values are stored as compressed JSON. The database uses WAL mode so
+    that several processes can read and write it concurrently. Entries
+    for other versions of a grammar are deleted as soon as a new
+    version is seen, and a background thread periodically deletes the
+    least recently used entries so the stored (compressed) values stay
+    within *maxbytes*.
+
+    Args:
+        path: the database file; it is created if necessary
+        maxbytes: the maximum total size of the compressed values
+        ttl: number of seconds entries remain valid, or `None` if they
+            do not expire
+        interval: number of seconds between eviction passes
+    """
+
+    def __init__(self, path, maxbytes=1024 * 1024 * 1024, ttl=None,
+                 interval=60):
+        self.path = path
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.interval = interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._versions = {}  # grammar: last version seen
+        self._accessed = {}  # key: time; access times not yet written
+        self._pid = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._connect().close()  # create tables, fail early if unusable
+
+    def get(self, key, default=None):
+        row = self._db().execute(
+            'SELECT value, expiry FROM results WHERE key = ?',
+            (_key_digest(key),)
+        ).fetchone()
+        with self._lock:
+            if row is None or (row[1] is not None and row[1] < time.time()):
+                self.misses += 1
+                return default
+            self.hits += 1
+            # access times are written in batches by the eviction thread,
+            # which read-only processes have not started in set()
+            self._accessed[_key_digest(key)] = time.time()
+        self._start_evictor()
+        return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+
+    def set(self, key, value):
+        self._start_evictor()
+        grammar, version = key[1], json.dumps(key[2])
+        blob = zlib.compress(json.dumps(value).encode('utf-8'))
+        now = time.time()
+        expiry = None if self.ttl is None else now + self.ttl
+        with self._lock:
+            # first write for this grammar version in this process (or
+            # thread, if several race); anything for earlier versions
+            # can no longer be hit
+            purge = self._versions.get(grammar) != version
+            self._versions[grammar] = version
+        db = self._db()
+        try:
+            with db:
+                if purge:
+                    db.execute(
+                        'DELETE FROM results '
+                        'WHERE grammar = ? AND version != ?',
+                        (grammar, version)
+                    )
+                db.execute(
+                    'INSERT OR REPLACE INTO results '
+                    '(key, grammar, version, value, size, atime, expiry) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (_key_digest(key), grammar, version,
+                     sqlite3.Binary(blob), len(blob), now, expiry)
+                )
+        except BaseException:
+            if purge:
+                with self._lock:  # so the next write purges instead
+                    if self._versions.get(grammar) == version:
+                        del self._versions[grammar]
+            raise
+
+    def clear(self):
+        db = self._db()
+        with db:
+            db.execute('DELETE FROM results')
+
+    def stats(self):
+        entries, size = self._db().execute(
+            'SELECT COUNT(*), TOTAL(size) FROM results'
+        ).fetchone()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'backend': 'sqlite',
+                'path': self.path,
+                'entries': entries,
+                'bytes': int(size),
+                'maxbytes': self.maxbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions
+            }
+
+    def evict(self):
+        """Delete expired entries and keep the total within maxbytes."""
+        with self._lock:
+            accessed, self._accessed = self._accessed, {}
+        db = self._db()
+        with db:
+            db.executemany(
+                'UPDATE results SET atime = ? WHERE key = ?',
+                [(t, k) for k, t in accessed.items()]
+            )
+            deleted = db.execute(
+                'DELETE FROM results WHERE expiry < ?', (time.time(),)
+            ).rowcount
+            total = db.execute('SELECT TOTAL(size) FROM results').fetchone()[0]
+            if total > self.maxbytes:
+                stale = []
+                for key, size in db.execute(
+                        'SELECT key, size FROM results ORDER BY atime'):
+                    stale.append((key,))
+                    total -= size
+                    if total <= self.maxbytes:
+                        break
+                db.executemany('DELETE FROM results WHERE key = ?', stale)
+                deleted += len(stale)
+        with self._lock:
+            self.evictions += deleted
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        with db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                ' key TEXT PRIMARY KEY,'
+                ' grammar TEXT,'
+                ' version TEXT,'
+                ' value BLOB,'
+                ' size INTEGER,'
+                ' atime REAL,'
+                ' expiry REAL)'
+            )
+            db.execute('CREATE INDEX IF NOT EXISTS results_atime '
+                       'ON results (atime)')
+        return db
+
+    def _db(self):
+        # connections cannot be shared across threads or forks
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.db = self._connect()
+            local.pid = os.getpid()
+        return local.db
+
+    def _start_evictor(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        t = threading.Thread(target=self._evict_loop)
+        t.daemon = True
+        t.start()
+
+    def _evict_loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.evict()
+            except sqlite3.Error:
+                logging.exception('Could not evict cache entries.')
+
+
+class TieredCache(object):
+    """
+    Caches consulted in order, e.g., a MemoryCache before an SqliteCache.
+
+    Values found in a later cache are copied into the earlier ones, and
+    new values are written to all of them.
+    """
+
+    def __init__(self, *caches):
+        self.caches = caches
+
+    def get(self, key, default=None):
+        for i, cache in enumerate(self.caches):
+            value = cache.get(key)
+            if value is not None:
+                for earlier in self.caches[:i]:
+                    earlier.set(key, value)
+                return value
+        return default
+
+    def set(self, key, value):
+        for cache in self.caches:
+            cache.set(key, value)
+
+    def clear(self):
+        for cache in self.caches:
+            cache.clear()
+
+    def stats(self):
+        return [cache.stats() for cache in self.caches]
+
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent calls for the same key.
+
+    While a call for a key is running, other calls for that key wait
+    for it and share its result (or exception) instead of repeating
+    the work, e.g., when many clients follow the same shared link
+    before its result is cached.
+    """
+
+    def __init__(self):
+        self._calls = {}  # key: _Call
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._calls)
+
+    def do(self, key, func, *args):
+        """
+        Return func(*args), or the result of the call for *key* that
+        is already running.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'active': len(self._calls),
+                'calls': self.calls,
+                'coalesced': self.coalesced
+            }
+
+
+class _Call(object):
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _key_digest(key):
+    return hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+
+
+def _json_size(value):
+    return len(json.dumps(value))
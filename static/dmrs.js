@@ -10,6 +10,8 @@ var level_dy = 25,  // vertical separation between edges
 var color = d3.scale.category20();
 
 function prepareGraph(graph) {
+    graph.sticky = false;
+    if ("maxTopLevel" in graph) return;  // already laid out by the server
     var nodeIdx = {}, levelIdx = {};
     graph.nodes.forEach(function(d, i) {
         nodeIdx[d.id] = i;
@@ -42,7 +44,6 @@ function prepareGraph(graph) {
             }
         });
     }
-    graph.sticky = false;
 }
 
 function nextAvailableLevel(source, target, dir, lvlIdx) {
@@ -427,7 +428,9 @@ function showParseResults(result) {
       .attr("href", "javascript:void(0)")
       .text('Generate')
       .on("click", function(d) { generateSentences(this.parentElement, d.mrs); });
-  d3.select("#parsestatus").text(result.NOTES);
+  d3.select("#parsestatus").text(
+    "TIMEOUT" in result ? result.ERRORS.join(" ") : result.NOTES
+  );
 }
 
 function generateSentences(elem, mrs) {
@@ -0,0 +1,129 @@
+
+#
+# Tests of batches spread over pooled processes in acepool, with a
+# stand-in for ACE that answers instantly except on "slow" items.
+#
+# Run with: python -m unittest discover tests
+
+import os
+import sys
+import threading
+import unittest
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from acepool import AcePool, TIMED_OUT
+from minidelphin import interact_from_iterable
+
+
+class FakeAce(object):
+    # answers each datum with {'SENT': datum}; items containing "slow"
+    # take *delay* seconds, unless the process is aborted first
+
+    delay = 0.2
+
+    def __init__(self, grm, **kwargs):
+        self._sent = deque()
+        self._aborted = threading.Event()
+        self._eof = False
+
+    def send(self, datum):
+        self._sent.append(datum)
+
+    def receive(self):
+        datum = self._sent.popleft()
+        if 'slow' in datum:
+            self._aborted.wait(self.delay)
+        if self._aborted.is_set():
+            self._eof = True
+            return {'SENT': None}
+        return {'SENT': datum}
+
+    def is_alive(self):
+        return not self._aborted.is_set()
+
+    def at_eof(self):
+        return self._eof
+
+    def abort(self):
+        self._aborted.set()
+
+    kill = abort
+
+    def close(self):
+        pass
+
+
+class HangingAce(FakeAce):
+    delay = 30
+
+
+def mixed_inputs(count=300, every=60):
+    return ['slow %d' % i if i % every == 0 else 'fast %d' % i
+            for i in range(count)]
+
+
+class InteractParallelTest(unittest.TestCase):
+
+    def run_batch(self, pool, inputs, limit=20, **kwargs):
+        # the results of a batch, failing if it does not finish in time
+        results = []
+
+        def run():
+            for item in pool.interact_parallel(
+                    inputs, interact_from_iterable, **kwargs):
+                results.append(item)
+
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+        t.join(limit)
+        self.assertFalse(t.is_alive(), 'batch hung after %d results'
+                         % len(results))
+        return results
+
+    def test_ordered_with_slow_items(self):
+        pool = AcePool(FakeAce, 'grammar', minsize=0, maxsize=4)
+        inputs = mixed_inputs()
+        results = self.run_batch(pool, inputs, workers=4, ordered=True)
+        self.assertEqual([datum for datum, _, _ in results], inputs)
+        self.assertEqual([resp['SENT'] for _, resp, _ in results], inputs)
+
+    def test_ordered_with_small_window(self):
+        pool = AcePool(FakeAce, 'grammar', minsize=0, maxsize=4)
+        inputs = mixed_inputs(count=100, every=25)
+        results = self.run_batch(pool, inputs, workers=4, ordered=True,
+                                 window=1)
+        self.assertEqual([datum for datum, _, _ in results], inputs)
+
+    def test_completion_order_with_slow_items(self):
+        pool = AcePool(FakeAce, 'grammar', minsize=0, maxsize=4)
+        inputs = mixed_inputs()
+        results = self.run_batch(pool, inputs, workers=4, ordered=False)
+        self.assertEqual(sorted(datum for datum, _, _ in results),
+                         sorted(inputs))
+        self.assertNotEqual([datum for datum, _, _ in results], inputs)
+
+    def test_budget(self):
+        pool = AcePool(HangingAce, 'grammar', minsize=0, maxsize=4)
+        inputs = mixed_inputs()
+        results = self.run_batch(pool, inputs, workers=4, ordered=True,
+                                 budget=0.2)
+        self.assertEqual([datum for datum, _, _ in results], inputs)
+        for datum, response, _ in results:
+            if datum.startswith('slow'):
+                self.assertIs(response, TIMED_OUT)
+            else:
+                self.assertEqual(response['SENT'], datum)
+
+    def test_no_process_for_empty_batch(self):
+        pool = AcePool(FakeAce, 'grammar', minsize=0, maxsize=4)
+        self.assertEqual(self.run_batch(pool, [], workers=4), [])
+        self.assertEqual(list(pool.interact_many([], interact_from_iterable)),
+                         [])
+        self.assertEqual(pool._size, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+
+#
+# Tests of the binary MRS encoding in minidelphin: loadb() must give
+# back exactly what dumpb() was given, as Xmrs or CompactXmrs, and
+# must reject truncated or corrupt input with XmrsDeserializationError.
+#
+# Run with: python -m unittest discover tests
+
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from minidelphin import (
+    Xmrs, CompactXmrs, Pred, XmrsError, XmrsDeserializationError,
+    loads_one, dumps_one, fast_dumps_one, dumpb, loadb, dumpb_one,
+    loadb_one
+)
+
+CORPUS = os.path.join(os.path.dirname(__file__), 'mrs-corpus.txt')
+
+
+def read_corpus():
+    with open(CORPUS) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+class RoundTripTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.corpus = [loads_one(s) for s in read_corpus()]
+
+    def test_xmrs(self):
+        decoded = loadb(dumpb(self.corpus))
+        self.assertEqual(len(decoded), len(self.corpus))
+        for i, (x, y) in enumerate(zip(self.corpus, decoded)):
+            self.assertIsInstance(y, Xmrs)
+            # SimpleMRS also compares properties, lnks, and surfaces
+            self.assertEqual(dumps_one(y), dumps_one(x), 'MRS %d' % i)
+
+    def test_compact(self):
+        decoded = loadb(dumpb(self.corpus), compact=True)
+        for i, (x, y) in enumerate(zip(self.corpus, decoded)):
+            self.assertIsInstance(y, CompactXmrs)
+            self.assertEqual(y, x, 'MRS %d' % i)
+            self.assertEqual(fast_dumps_one(y), dumps_one(x), 'MRS %d' % i)
+
+    def test_from_compact(self):
+        for i, x in enumerate(self.corpus):
+            c = CompactXmrs.from_xmrs(x)
+            self.assertEqual(dumps_one(loadb_one(dumpb_one(c))),
+                             dumps_one(x), 'MRS %d' % i)
+
+    def test_single(self):
+        x = self.corpus[0]
+        self.assertEqual(dumps_one(loadb_one(dumpb_one(x))), dumps_one(x))
+
+    def test_empty(self):
+        self.assertEqual(loadb(dumpb([])), [])
+
+    def test_wide_ints(self):
+        # nodeids beyond 32 bits, and negative lnk offsets
+        x = Xmrs(top='h0', eps=[
+            (2 ** 40, Pred.stringpred('_dog_n_1_rel'), 'h1', {'ARG0': 'x2'},
+             (0, (-1, -1)))
+        ], hcons=[('h0', 'qeq', 'h1')])
+        self.assertEqual(loadb_one(dumpb_one(x)).eps(), x.eps())
+
+    def test_nul(self):
+        x = Xmrs(top='h0', surface='a\0b')
+        self.assertRaises(XmrsError, dumpb_one, x)
+
+
+class RejectTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.corpus = [loads_one(s) for s in read_corpus()]
+        cls.data = dumpb(cls.corpus[:3])
+
+    def test_magic(self):
+        self.assertRaises(XmrsDeserializationError, loadb, b'')
+        self.assertRaises(XmrsDeserializationError, loadb,
+                          b'MRSB\x02' + self.data[5:])
+        self.assertRaises(XmrsDeserializationError, loadb,
+                          dumps_one(self.corpus[0]).encode('utf-8'))
+
+    def test_truncated(self):
+        for size in range(len(self.data)):
+            self.assertRaises(XmrsDeserializationError, loadb,
+                              self.data[:size])
+
+    def test_corrupt(self):
+        # any other error would escape callers that expect this one
+        rng = random.Random(0)
+        for _ in range(2000):
+            data = bytearray(self.data)
+            for _ in range(rng.randint(1, 4)):
+                data[rng.randrange(len(data))] = rng.randrange(256)
+            for compact in (False, True):
+                try:
+                    loadb(bytes(data), compact=compact)
+                except XmrsDeserializationError:
+                    pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+
+#
+# Tests of canonicalize() and fingerprint() in minidelphin: MRSs that
+# differ only in variable names and the order of their EPs and
+# constraints must have the same canonical form and fingerprint, so
+# they are cached and compared as one.
+#
+# Each MRS of mrs-corpus.txt (see test_dmrs.py) is scrambled by
+# renaming its variables at random and shuffling its EPs and HCONS.
+#
+# Run with: python -m unittest discover tests
+
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from minidelphin import (
+    Xmrs, CompactXmrs, loads_one, dumps_one, canonicalize, fingerprint,
+    dedupe, var_re
+)
+
+CORPUS = os.path.join(os.path.dirname(__file__), 'mrs-corpus.txt')
+
+
+def read_corpus():
+    with open(CORPUS) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def scramble(xmrs, seed):
+    # *xmrs* with its variables renamed, and its EPs (with new nodeids)
+    # and constraints shuffled, by the random generator seeded by *seed*
+    rng = random.Random(seed)
+    variables = xmrs.variables()
+    numbers = rng.sample(range(len(variables) * 10), len(variables))
+    names = dict((var, '%s%d' % (var_re.match(var).group(1), num))
+                 for var, num in zip(variables, numbers))
+
+    def rename(val):
+        return names.get(val, val)
+
+    eps = []
+    for ep in xmrs.eps():
+        args = dict((role, rename(val)) for role, val in ep[3].items())
+        eps.append((ep[0] + 50000, ep[1], rename(ep[2]), args) +
+                   tuple(ep[4:]))
+    rng.shuffle(eps)
+    hcons = [(rename(hi), reln, rename(lo)) for hi, reln, lo in xmrs.hcons()]
+    rng.shuffle(hcons)
+    icons = [(rename(l), reln, rename(r)) for l, reln, r in xmrs.icons()]
+    rng.shuffle(icons)
+    return Xmrs(
+        top=rename(xmrs.top), index=rename(xmrs.index),
+        xarg=rename(xmrs.xarg), eps=eps, hcons=hcons, icons=icons,
+        vars=dict((names[var], sorted(xmrs.properties(var).items()))
+                  for var in variables),
+        lnk=xmrs.lnk, surface=xmrs.surface
+    )
+
+
+class CanonicalizeTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.corpus = [loads_one(s) for s in read_corpus()]
+
+    def test_same_under_renaming_and_reordering(self):
+        for i, x in enumerate(self.corpus):
+            expected = dumps_one(canonicalize(scramble(x, 0)))
+            for seed in (1, 2, 3):
+                self.assertEqual(dumps_one(canonicalize(scramble(x, seed))),
+                                 expected, 'MRS %d, seed %d' % (i, seed))
+
+    def test_equal_to_input(self):
+        # only the names and order change, so the structure is the same
+        for i, x in enumerate(self.corpus):
+            c = canonicalize(x)
+            self.assertEqual(len(c.eps()), len(x.eps()), 'MRS %d' % i)
+            self.assertEqual(sorted(ep[1].string for ep in c.eps()),
+                             sorted(ep[1].string for ep in x.eps()),
+                             'MRS %d' % i)
+            self.assertEqual(len(c.hcons()), len(x.hcons()), 'MRS %d' % i)
+
+    def test_idempotent(self):
+        for i, x in enumerate(self.corpus):
+            c = canonicalize(x)
+            self.assertEqual(dumps_one(canonicalize(c)), dumps_one(c),
+                             'MRS %d' % i)
+
+    def test_differs_for_different_structure(self):
+        a = loads_one('[ TOP: h0 RELS: < [ _dog_n_1_rel<0:3> LBL: h1 '
+                      'ARG0: x2 ] > HCONS: < > ]')
+        b = loads_one('[ TOP: h0 RELS: < [ _cat_n_1_rel<0:3> LBL: h1 '
+                      'ARG0: x2 ] > HCONS: < > ]')
+        self.assertNotEqual(dumps_one(canonicalize(a)),
+                            dumps_one(canonicalize(b)))
+
+
+class FingerprintTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.corpus = [loads_one(s) for s in read_corpus()]
+
+    def test_same_under_renaming_and_reordering(self):
+        for i, x in enumerate(self.corpus):
+            expected = fingerprint(x)
+            for seed in (1, 2, 3):
+                self.assertEqual(fingerprint(scramble(x, seed)), expected,
+                                 'MRS %d, seed %d' % (i, seed))
+
+    def test_compact_xmrs(self):
+        for i, x in enumerate(self.corpus):
+            self.assertEqual(fingerprint(CompactXmrs.from_xmrs(x)),
+                             fingerprint(x), 'MRS %d' % i)
+
+    def test_distinct_structures(self):
+        # as many fingerprints as canonical forms in the corpus
+        forms = set(dumps_one(canonicalize(x)) for x in self.corpus)
+        prints = set(fingerprint(x) for x in self.corpus)
+        self.assertEqual(len(prints), len(forms))
+
+    def test_lnk(self):
+        a = loads_one('[ TOP: h0 RELS: < [ _dog_n_1_rel<0:3> LBL: h1 '
+                      'ARG0: x2 ] > HCONS: < > ]')
+        b = loads_one('[ TOP: h0 RELS: < [ _dog_n_1_rel<4:7> LBL: h1 '
+                      'ARG0: x2 ] > HCONS: < > ]')
+        self.assertNotEqual(fingerprint(a), fingerprint(b))
+        self.assertEqual(fingerprint(a, lnk=False), fingerprint(b, lnk=False))
+
+    def test_dedupe(self):
+        x = self.corpus[0]
+        y = self.corpus[1]
+        items = [x, scramble(x, 1), y, scramble(y, 2), scramble(x, 3)]
+        self.assertEqual(dedupe(items), [x, y])
+
+
+if __name__ == '__main__':
+    unittest.main()
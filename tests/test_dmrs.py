@@ -0,0 +1,67 @@
+
+#
+# Differential tests of the one-pass DMRS extraction in minidelphin:
+# nodes_and_links() and fast_nodes_and_links() must give exactly what
+# nodes() and links() give, for Xmrs and CompactXmrs alike.
+#
+# mrs-corpus.txt has one SimpleMRS per line: a few hand-written MRSs
+# (CARGs, lnk-less EPs, a shared labelset, ICONS, no TOP) followed by
+# synthetic ERG-style MRSs, two thirds of which were mutated to share
+# labels across EPs, take label and unbound arguments, and lose HCONS.
+#
+# Run with: python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from minidelphin import (
+    loads_one, fast_loads_one, nodes, links, nodes_and_links,
+    fast_nodes_and_links, CompactXmrs
+)
+
+CORPUS = os.path.join(os.path.dirname(__file__), 'mrs-corpus.txt')
+
+
+def read_corpus():
+    with open(CORPUS) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+class NodesAndLinksTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.corpus = read_corpus()
+
+    def assertSameDmrs(self, i, actual, xmrs):
+        expected = (nodes(xmrs), links(xmrs))
+        self.assertEqual(actual[0], expected[0], 'nodes of MRS %d' % i)
+        self.assertEqual(actual[1], expected[1], 'links of MRS %d' % i)
+
+    def test_xmrs(self):
+        for i, s in enumerate(self.corpus):
+            x = loads_one(s)
+            self.assertSameDmrs(i, nodes_and_links(x), x)
+
+    def test_fast_loads_xmrs(self):
+        for i, s in enumerate(self.corpus):
+            x = fast_loads_one(s)
+            self.assertSameDmrs(i, nodes_and_links(x), x)
+
+    def test_compact_xmrs(self):
+        for i, s in enumerate(self.corpus):
+            x = loads_one(s)
+            c = CompactXmrs.from_xmrs(x)
+            self.assertSameDmrs(i, nodes_and_links(c), x)
+            self.assertSameDmrs(i, (nodes(c), links(c)), x)
+
+    def test_fast_nodes_and_links(self):
+        for i, s in enumerate(self.corpus):
+            self.assertSameDmrs(i, fast_nodes_and_links(s), loads_one(s))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+
+#
+# Tests of iterload() in minidelphin: reading a SimpleMRS file in
+# chunks of any size, or memory-mapped, must give the same MRSs as
+# loads_one() gives for each, including MRSs whose quoted strings hold
+# brackets, escaped quotes, and multi-byte characters that a chunk
+# boundary may split.
+#
+# Run with: python -m unittest discover tests
+
+import io
+import os
+import sys
+import mmap
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from minidelphin import (
+    loads_one, dumps_one, iterload, XmrsDeserializationError
+)
+
+CORPUS = os.path.join(os.path.dirname(__file__), 'mrs-corpus.txt')
+
+# brackets and an escaped quote in quoted strings, and non-ASCII text
+QUOTED = (u'[ "K]im \\"[\u00e9\\" ]" TOP: h0 RELS: < [ named_rel<0:3> '
+          u'LBL: h1 ARG0: x2 CARG: "K]i\\"m [\u00e9" ] > HCONS: < > ]')
+
+
+def read_corpus():
+    with open(CORPUS) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+class IterloadTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.mrss = [QUOTED] + read_corpus()[:20] + [QUOTED]
+        cls.expected = [dumps_one(loads_one(s)) for s in cls.mrss]
+        # MRSs split across lines and run together, as well as one per
+        # line, so MRS boundaries do not fall on line boundaries
+        cls.text = u'\n'.join(cls.mrss) + u'\n' + u''.join(cls.mrss)
+        cls.expected = cls.expected * 2
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.path = os.path.join(cls.tmpdir, 'corpus.mrs')
+        with io.open(cls.path, 'w', encoding='utf-8') as f:
+            f.write(cls.text)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def assertLoads(self, ms):
+        self.assertEqual([dumps_one(m) for m in ms], self.expected)
+
+    def test_text_chunks(self):
+        for size in (1, 2, 3, 7, 64, 65536):
+            self.assertLoads(iterload(io.StringIO(self.text), chunksize=size))
+
+    def test_binary_chunks(self):
+        # chunks of 1 byte split the 2-byte UTF-8 characters
+        data = self.text.encode('utf-8')
+        for size in (1, 2, 3, 7, 64, 65536):
+            self.assertLoads(iterload(io.BytesIO(data), chunksize=size))
+
+    def test_filename(self):
+        self.assertLoads(iterload(self.path, chunksize=100))
+
+    def test_mmap(self):
+        self.assertLoads(iterload(self.path, use_mmap=True))
+        with open(self.path, 'rb') as f:
+            self.assertLoads(iterload(f, use_mmap=True))
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                self.assertLoads(iterload(mm))
+            finally:
+                mm.close()
+
+    def test_empty(self):
+        path = os.path.join(self.tmpdir, 'empty.mrs')
+        open(path, 'w').close()
+        self.assertEqual(list(iterload(path)), [])
+        self.assertEqual(list(iterload(path, use_mmap=True)), [])
+
+    def test_lazy(self):
+        # the first MRS is given before the rest of the file is read
+        ms = iterload(io.StringIO(self.mrss[0] + u' [ TOP: h0'), chunksize=1)
+        self.assertEqual(dumps_one(next(ms)), self.expected[0])
+        self.assertRaises(XmrsDeserializationError, next, ms)
+
+    def test_invalid(self):
+        for text in (self.mrss[0][:-1], self.mrss[0] + u' ]'):
+            for size in (1, 65536):
+                self.assertRaises(XmrsDeserializationError, list,
+                                  iterload(io.StringIO(text), chunksize=size))
+            path = os.path.join(self.tmpdir, 'invalid.mrs')
+            with io.open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            self.assertRaises(XmrsDeserializationError, list,
+                              iterload(path, use_mmap=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
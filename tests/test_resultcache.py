@@ -0,0 +1,215 @@
+
+#
+# Tests of the result caches in resultcache: MemoryCache and
+# SqliteCache must stay within their byte limits by dropping the least
+# recently used entries, and SqliteCache must drop the entries for a
+# grammar when a new version of it is seen, even by another instance
+# (as in another process). Concurrent SingleFlight calls for one key
+# must run it once and share its result or error.
+#
+# Run with: python -m unittest discover tests
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from resultcache import MemoryCache, SqliteCache, SingleFlight
+
+
+class MemoryCacheTest(unittest.TestCase):
+
+    def test_lru(self):
+        cache = MemoryCache(maxbytes=3, sizeof=lambda value: 1)
+        for key in 'abc':
+            cache.set(key, key.upper())
+        self.assertEqual(cache.get('a'), 'A')  # now the most recent
+        cache.set('d', 'D')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual([cache.get(key) for key in 'acd'], ['A', 'C', 'D'])
+        self.assertEqual(cache.evictions, 1)
+
+    def test_bytes(self):
+        cache = MemoryCache(maxbytes=10, sizeof=len)
+        cache.set('a', 'x' * 4)
+        cache.set('b', 'x' * 4)
+        self.assertEqual(cache.stats()['bytes'], 8)
+        cache.set('c', 'x' * 4)  # evicts a
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['bytes'], 8)
+        cache.set('b', 'x' * 2)  # replaces b
+        self.assertEqual(cache.stats()['bytes'], 6)
+        self.assertEqual(len(cache), 2)
+
+    def test_too_large(self):
+        # a value larger than the cache is not stored, and evicts nothing
+        cache = MemoryCache(maxbytes=10, sizeof=len)
+        cache.set('a', 'x' * 4)
+        cache.set('b', 'x' * 11)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'x' * 4)
+        self.assertEqual(cache.evictions, 0)
+
+    def test_json_size(self):
+        cache = MemoryCache()
+        cache.set('a', {'x': [1, 2]})
+        self.assertEqual(cache.stats()['bytes'], len('{"x": [1, 2]}'))
+
+    def test_ttl(self):
+        cache = MemoryCache(ttl=-1)  # already expired when set
+        cache.set('a', 'A')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()['bytes'], 0)
+        self.assertEqual(cache.expirations, 1)
+
+    def test_stats(self):
+        cache = MemoryCache()
+        cache.set('a', 'A')
+        cache.get('a')
+        cache.get('b', 'default')
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+
+def key(grammar, version, sent):
+    # as demophin.parse_key()
+    return ('parse', grammar, version, sent)
+
+
+class SqliteCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def cache(self, **kwargs):
+        # the eviction thread is kept out of the way; tests call evict()
+        return SqliteCache(self.path, interval=3600, **kwargs)
+
+    def test_get_set(self):
+        cache = self.cache()
+        cache.set(key('erg', 1, 'a'), {'RESULTS': [1, 2]})
+        self.assertEqual(cache.get(key('erg', 1, 'a')), {'RESULTS': [1, 2]})
+        self.assertIsNone(cache.get(key('erg', 1, 'b')))
+        self.assertEqual(self.cache().get(key('erg', 1, 'a')),
+                         {'RESULTS': [1, 2]})
+
+    def test_version_purge(self):
+        cache = self.cache()
+        cache.set(key('erg', 1, 'a'), 'A1')
+        cache.set(key('erg', 1, 'b'), 'B1')
+        cache.set(key('jacy', 1, 'a'), 'JA1')
+        cache.set(key('erg', 2, 'a'), 'A2')
+        self.assertIsNone(cache.get(key('erg', 1, 'a')))
+        self.assertIsNone(cache.get(key('erg', 1, 'b')))
+        self.assertEqual(cache.get(key('erg', 2, 'a')), 'A2')
+        self.assertEqual(cache.get(key('jacy', 1, 'a')), 'JA1')
+        self.assertEqual(cache.stats()['entries'], 2)
+
+    def test_version_purge_by_other_instance(self):
+        first, second = self.cache(), self.cache()
+        first.set(key('erg', 1, 'a'), 'A1')
+        second.set(key('erg', 2, 'b'), 'B2')
+        self.assertIsNone(first.get(key('erg', 1, 'a')))
+        self.assertEqual(first.get(key('erg', 2, 'b')), 'B2')
+
+    def test_evict_lru(self):
+        cache = self.cache()
+        for sent in 'abcd':
+            cache.set(key('erg', 1, sent), sent * 100)
+            time.sleep(0.01)  # distinct access times
+        size = cache.stats()['bytes'] // 4
+        self.assertEqual(cache.get(key('erg', 1, 'a')), 'a' * 100)
+        cache.maxbytes = 2 * size
+        cache.evict()
+        self.assertEqual(cache.stats()['entries'], 2)
+        self.assertEqual(cache.evictions, 2)
+        # a was used most recently, then d
+        self.assertEqual([cache.get(key('erg', 1, sent)) is not None
+                          for sent in 'abcd'], [True, False, False, True])
+
+    def test_expiry(self):
+        cache = self.cache(ttl=-1)  # already expired when set
+        cache.set(key('erg', 1, 'a'), 'A')
+        self.assertIsNone(cache.get(key('erg', 1, 'a')))
+        cache.evict()
+        self.assertEqual(cache.stats()['entries'], 0)
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def run_calls(self, flight, func, count=8):
+        # call flight.do('key', func) on *count* threads at once and
+        # return [(result, error), ...]; *func* is released once the
+        # other calls are waiting on it
+        release = threading.Event()
+        outcomes = [None] * count
+
+        def call(i):
+            try:
+                outcomes[i] = (flight.do('key', func, release), None)
+            except Exception as e:
+                outcomes[i] = (None, e)
+
+        threads = [threading.Thread(target=call, args=(i,))
+                   for i in range(count)]
+        for t in threads:
+            t.start()
+        deadline = time.time() + 10
+        while flight.stats()['coalesced'] < count - 1:
+            self.assertLess(time.time(), deadline, 'calls did not coalesce')
+            time.sleep(0.001)
+        release.set()
+        for t in threads:
+            t.join(10)
+        return outcomes
+
+    def test_shared_result(self):
+        flight = SingleFlight()
+        calls = []
+
+        def func(release):
+            calls.append(1)
+            release.wait(10)
+            return object()
+
+        outcomes = self.run_calls(flight, func)
+        self.assertEqual(len(calls), 1)
+        result = outcomes[0][0]
+        self.assertEqual(outcomes, [(result, None)] * len(outcomes))
+        self.assertEqual(flight.stats(),
+                         {'active': 0, 'calls': 1, 'coalesced': 7})
+
+    def test_shared_error(self):
+        flight = SingleFlight()
+
+        def func(release):
+            release.wait(10)
+            raise ValueError('no parse')
+
+        outcomes = self.run_calls(flight, func)
+        error = outcomes[0][1]
+        self.assertIsInstance(error, ValueError)
+        self.assertEqual(outcomes, [(None, error)] * len(outcomes))
+        self.assertEqual(len(flight), 0)
+
+    def test_after_call(self):
+        # a finished call is not shared with later ones
+        flight = SingleFlight()
+        self.assertEqual(flight.do('key', lambda: 1), 1)
+        self.assertEqual(flight.do('key', lambda: 2), 2)
+        self.assertEqual(flight.stats()['coalesced'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()